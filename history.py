@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+"""
+Embedded time-series store for Venstar ColorTouch thermostat state history
+by Goose66 (W. Randy King) kingwrandy@gmail.com
+"""
+
+import os
+import json
+import mmap
+import calendar
+import struct
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# Configure a module level logger for module testing
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.setLevel(logging.DEBUG)
+
+# fixed-width records stored in the data files
+# raw: timestamp (epoch seconds), series id, value
+# hourly: hour start (epoch seconds), series id, minimum, maximum, mean
+_RAW_RECORD = struct.Struct("<IHf")
+_HOURLY_RECORD = struct.Struct("<IHfff")
+
+# layout of the store directory
+_SERIES_FILE = "series.json"
+_ROLLUP_FILE = "rollup.json" # last day downsampled and the value of each series carried into the next day
+_RAW_DIR = "raw"
+_HOURLY_DIR = "hourly"
+_RAW_FILE_FORMAT = "%Y%m%d.dat" # one raw file per (UTC) day
+_HOURLY_FILE_FORMAT = "%Y%m.dat" # one hourly file per (UTC) month
+
+# resolutions for queries
+RESOLUTION_RAW = "raw"
+RESOLUTION_HOURLY = "hourly"
+
+# defaults for the store (in seconds unless noted)
+_DEFAULT_RAW_RETENTION_DAYS = 7
+_DEFAULT_HOURLY_RETENTION_DAYS = 365
+_DEFAULT_FLUSH_INTERVAL = 10.0
+_MAINTENANCE_INTERVAL = 3600.0
+_MAX_PENDING_RECORDS = 100000 # records dropped beyond this if the writer falls behind
+_HEARTBEAT_INTERVAL = 3600.0 # unchanged values are recorded again after this long
+_MAX_CARRY_SECONDS = 2 * _HEARTBEAT_INTERVAL # a value is assumed to hold for at most this long without a new record
+_MAX_SERIES_ID = 0xFFFF # series ids are stored as unsigned shorts in the records
+
+_SECONDS_PER_DAY = 86400
+_SECONDS_PER_HOUR = 3600
+
+# returns the series key for a node address and field
+def getSeriesKey(address, field):
+    return "{}/{}".format(address, field)
+
+# reads the fixed-width records from a data file using a memory map
+def _readRecords(fileName, record):
+
+    try:
+        with open(fileName, "rb") as f:
+
+            # ignore a partial record at the end from a write in progress
+            size = os.fstat(f.fileno()).st_size
+            size -= size % record.size
+            if size == 0:
+                return []
+
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as m:
+                return list(record.iter_unpack(m))
+
+    except FileNotFoundError:
+        return []
+
+# replaces the contents of a file with a temporary file, so a crash leaves either the old or the new contents
+def _replaceFile(fileName, data, mode="wb"):
+
+    with open(fileName + ".tmp", mode) as f:
+        f.write(data)
+    os.replace(fileName + ".tmp", fileName)
+
+# Local time-series store with a background writer thread
+class historyStore(object):
+
+    _path = None
+    _rawRetentionDays = _DEFAULT_RAW_RETENTION_DAYS
+    _hourlyRetentionDays = _DEFAULT_HOURLY_RETENTION_DAYS
+    _flushInterval = _DEFAULT_FLUSH_INTERVAL
+    _logger = None
+    _series = None
+    _seriesSaved = 0
+    _lastValues = None
+    _lastTimes = None
+    _lastSeen = None
+    _seriesFull = False
+    _pending = None
+    _droppedRecords = 0
+    _lock = None
+    _flushLock = None
+    _wakeEvent = None
+    _stopEvent = None
+    _thread = None
+    _lastMaintenance = 0.0
+
+    # Primary constructor method
+    def __init__(self, path, rawRetentionDays=_DEFAULT_RAW_RETENTION_DAYS, hourlyRetentionDays=_DEFAULT_HOURLY_RETENTION_DAYS, flushInterval=_DEFAULT_FLUSH_INTERVAL, logger=_LOGGER):
+        """Creates a time-series store in a directory
+
+        Parameters:
+        path -- directory for the data files (created if needed)
+        rawRetentionDays -- number of days raw records are kept before they are downsampled to hourly records
+        hourlyRetentionDays -- number of days hourly records are kept
+        flushInterval -- how often (in seconds) recorded values are written to disk
+        logger -- logger to use for errors
+        """
+
+        self._path = path
+        self._rawRetentionDays = rawRetentionDays
+        self._hourlyRetentionDays = hourlyRetentionDays
+        self._flushInterval = flushInterval
+        self._logger = logger
+
+        self._lastValues = {}
+        self._lastTimes = {}
+        self._lastSeen = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wakeEvent = threading.Event()
+        self._stopEvent = threading.Event()
+
+        os.makedirs(os.path.join(path, _RAW_DIR), exist_ok=True)
+        os.makedirs(os.path.join(path, _HOURLY_DIR), exist_ok=True)
+
+        # load the series ids assigned to the series keys
+        try:
+            with open(os.path.join(path, _SERIES_FILE)) as f:
+                self._series = json.load(f)
+        except FileNotFoundError:
+            self._series = {}
+        except ValueError:
+            self._logger.warning("History series index in %s is corrupt - starting a new index.", path)
+            self._series = {}
+        self._seriesSaved = len(self._series)
+
+    # start the writer thread
+    def start(self):
+        """Starts the background thread that writes recorded values to disk and applies the retention"""
+
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._runWriter, name="historyWriter", daemon=True)
+        self._thread.start()
+
+    # stop the writer thread, writing any pending values
+    def stop(self):
+        """Stops the writer thread after writing any pending values to disk"""
+
+        self._stopEvent.set()
+        self._wakeEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    # record the value of a series, if it changed from the last value recorded
+    # Note: only queues the value in memory, so it is safe to call from the poll path
+    # Note: unchanged values still being observed are recorded again by the writer every heartbeat interval, so the hourly values have no gaps
+    def record(self, series, value, timestamp=None):
+        """Records a value for a series
+
+        Parameters:
+        series -- series key (see getSeriesKey())
+        value -- numeric value (stored as a 32-bit float)
+        timestamp -- time of the value in epoch seconds (defaults to now)
+        """
+
+        self.recordValues({series: value}, timestamp)
+
+    # record the values of several series at once
+    def recordValues(self, values, timestamp=None):
+        """Records values for several series at the same time
+
+        Parameters:
+        values -- dictionary of values keyed by series key
+        timestamp -- time of the values in epoch seconds (defaults to now)
+        """
+
+        timestamp = int(time.time() if timestamp is None else timestamp)
+
+        with self._lock:
+            for series in values:
+                self._lastSeen[series] = timestamp
+
+                # skip values that have not changed, so the store only holds the changes in each series
+                value = float(values[series])
+                if self._lastValues.get(series) == value:
+                    continue
+                self._queueRecord(series, value, timestamp)
+
+    # mark series as observed with unchanged values, so they are still recorded every heartbeat interval
+    def observe(self, series, timestamp=None):
+        """Marks series as observed with the values last recorded, e.g., for a poll that returned no changes
+
+        Parameters:
+        series -- list of series keys
+        timestamp -- time of the observation in epoch seconds (defaults to now)
+        """
+
+        timestamp = int(time.time() if timestamp is None else timestamp)
+
+        with self._lock:
+            for key in series:
+                if key in self._lastValues:
+                    self._lastSeen[key] = timestamp
+
+    # stop recording the last values of series, e.g., when the thermostat goes offline
+    def forget(self, series):
+        """Stops recording the last values of series until new values are recorded, leaving a gap in the history
+
+        Parameters:
+        series -- list of series keys
+        """
+
+        with self._lock:
+            for key in series:
+                self._lastValues.pop(key, None)
+                self._lastTimes.pop(key, None)
+                self._lastSeen.pop(key, None)
+
+    # queue a record for the writer, remembering the value only if it was queued
+    # Note: must be called with the lock held
+    def _queueRecord(self, series, value, timestamp):
+
+        if len(self._pending) >= _MAX_PENDING_RECORDS:
+            self._droppedRecords += 1
+            return
+
+        seriesID = self._series.get(series, len(self._series))
+
+        # don't record series with ids that don't fit in the records
+        if seriesID > _MAX_SERIES_ID:
+            if not self._seriesFull:
+                self._logger.warning("History store in %s is full - values for new series are not recorded.", self._path)
+                self._seriesFull = True
+            return
+
+        self._series.setdefault(series, seriesID)
+        self._pending.append((timestamp, seriesID, value))
+        self._lastValues[series] = value
+        self._lastTimes[series] = timestamp
+
+    # record the unchanged values again that have not been recorded for the heartbeat interval
+    # Note: only for series observed within the carry time, so a thermostat that stopped responding leaves a gap
+    def _recordHeartbeats(self):
+
+        timestamp = int(time.time())
+        with self._lock:
+            for series in list(self._lastValues):
+                if timestamp - self._lastTimes[series] >= _HEARTBEAT_INTERVAL and timestamp - self._lastSeen.get(series, 0) < _MAX_CARRY_SECONDS:
+                    self._queueRecord(series, self._lastValues[series], timestamp)
+
+    # write the pending values to disk
+    def flush(self):
+        """Writes values recorded since the last flush to disk"""
+
+        with self._flushLock:
+
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+                series = dict(self._series) if len(self._series) > self._seriesSaved else None
+                dropped = self._droppedRecords
+                self._droppedRecords = 0
+
+            if dropped:
+                self._logger.warning("History writer fell behind - %i value(s) dropped.", dropped)
+
+            try:
+                # save new series ids before any records referencing them
+                if series is not None:
+                    _replaceFile(os.path.join(self._path, _SERIES_FILE), json.dumps(series), "w")
+                    self._seriesSaved = len(series)
+
+                # append the records to the raw file for the day of each record in a single write per file
+                files = defaultdict(bytearray)
+                for timestamp, seriesID, value in pending:
+                    files[time.strftime(_RAW_FILE_FORMAT, time.gmtime(timestamp))] += _RAW_RECORD.pack(timestamp, seriesID, value)
+                for fileName in files:
+                    with open(os.path.join(self._path, _RAW_DIR, fileName), "ab") as f:
+                        f.write(files[fileName])
+
+            except (OSError, struct.error) as e:
+                self._logger.error("Unable to write history to %s: %s", self._path, str(e))
+
+    # writer thread loop
+    def _runWriter(self):
+
+        while not self._stopEvent.is_set():
+            self._wakeEvent.wait(self._flushInterval)
+            self._wakeEvent.clear()
+
+            # keep the writer running if a pass fails
+            try:
+                self._recordHeartbeats()
+                self.flush()
+            except Exception:
+                self._logger.exception("Unexpected error writing history to %s.", self._path)
+
+            # downsample and remove old records periodically
+            if time.time() - self._lastMaintenance >= _MAINTENANCE_INTERVAL:
+                self._lastMaintenance = time.time()
+                try:
+                    self.applyRetention()
+                except (OSError, struct.error) as e:
+                    self._logger.error("Unable to apply history retention in %s: %s", self._path, str(e))
+
+    # downsample raw files past the raw retention to hourly records and remove hourly files past the hourly retention
+    def applyRetention(self, now=None):
+        """Downsamples raw records older than the raw retention into hourly records and removes expired hourly records
+
+        Parameters:
+        now -- current time in epoch seconds (defaults to now)
+        """
+
+        now = time.time() if now is None else now
+
+        # downsample the raw files older than the raw retention, oldest first so each value carries into the next day
+        rawCutoff = time.strftime(_RAW_FILE_FORMAT, time.gmtime(now - self._rawRetentionDays * _SECONDS_PER_DAY))
+        rollup = self._loadRollup()
+        for fileName in sorted(os.listdir(os.path.join(self._path, _RAW_DIR))):
+            if fileName < rawCutoff and not fileName.endswith(".tmp"):
+                self._downsampleFile(fileName, rollup)
+
+        # remove the hourly files for months entirely past the hourly retention
+        hourlyCutoff = time.strftime(_HOURLY_FILE_FORMAT, time.gmtime(now - self._hourlyRetentionDays * _SECONDS_PER_DAY))
+        for fileName in os.listdir(os.path.join(self._path, _HOURLY_DIR)):
+            if fileName < hourlyCutoff:
+                os.remove(os.path.join(self._path, _HOURLY_DIR, fileName))
+
+    # load the last day downsampled and the values carried into the next day
+    def _loadRollup(self):
+
+        try:
+            with open(os.path.join(self._path, _ROLLUP_FILE)) as f:
+                rollup = json.load(f)
+            return {"day": rollup["day"], "values": {int(seriesID): tuple(value) for seriesID, value in rollup["values"].items()}}
+        except FileNotFoundError:
+            return {"day": "", "values": {}}
+        except (ValueError, KeyError, TypeError):
+            self._logger.warning("History rollup state in %s is corrupt - values not carried into the next day.", self._path)
+            return {"day": "", "values": {}}
+
+    # downsample a raw file to time-weighted hourly records and remove it
+    # Note: each step replaces a file, so the downsampling can be repeated after a crash without duplicating records
+    def _downsampleFile(self, fileName, rollup):
+
+        rawFileName = os.path.join(self._path, _RAW_DIR, fileName)
+        day = fileName[:8]
+
+        # remove the raw file if it was already downsampled before a crash
+        if day <= rollup["day"]:
+            os.remove(rawFileName)
+            return
+
+        dayStart = calendar.timegm(time.strptime(day, "%Y%m%d"))
+        dayEnd = dayStart + _SECONDS_PER_DAY
+
+        # collect the changes in each series for the day, starting with the value carried from the previous day
+        changes = defaultdict(list)
+        for seriesID, (timestamp, value) in rollup["values"].items():
+            if timestamp + _MAX_CARRY_SECONDS > dayStart:
+                changes[seriesID].append((timestamp, value))
+        for timestamp, seriesID, value in sorted(_readRecords(rawFileName, _RAW_RECORD)):
+            changes[seriesID].append((timestamp, value))
+
+        # aggregate each value over the hours it held for (until the next change, for at most the carry time)
+        hours = {}
+        for seriesID in changes:
+            values = changes[seriesID]
+            for n, (timestamp, value) in enumerate(values):
+                end = min(values[n + 1][0] if n + 1 < len(values) else dayEnd, timestamp + _MAX_CARRY_SECONDS, dayEnd)
+                start = max(timestamp, dayStart)
+                while start < end:
+                    hour = start - start % _SECONDS_PER_HOUR
+                    duration = min(end, hour + _SECONDS_PER_HOUR) - start
+                    aggregate = hours.get((hour, seriesID))
+                    if aggregate is None:
+                        hours[(hour, seriesID)] = [value, value, value * duration, duration]
+                    else:
+                        aggregate[0] = min(aggregate[0], value)
+                        aggregate[1] = max(aggregate[1], value)
+                        aggregate[2] += value * duration
+                        aggregate[3] += duration
+                    start += duration
+
+            # carry the last value into the next day
+            rollup["values"][seriesID] = values[-1]
+
+        # replace the records for the day in the hourly file for the month
+        hourlyFileName = os.path.join(self._path, _HOURLY_DIR, fileName[:6] + ".dat")
+        data = bytearray()
+        for values in _readRecords(hourlyFileName, _HOURLY_RECORD):
+            if not dayStart <= values[0] < dayEnd:
+                data += _HOURLY_RECORD.pack(*values)
+        for (hour, seriesID), (minimum, maximum, total, duration) in sorted(hours.items()):
+            data += _HOURLY_RECORD.pack(hour, seriesID, minimum, maximum, total / duration)
+        if data:
+            _replaceFile(hourlyFileName, data)
+
+        # save the day as downsampled, then remove the raw file
+        rollup["day"] = day
+        rollup["values"] = {seriesID: value for seriesID, value in rollup["values"].items() if value[0] + _MAX_CARRY_SECONDS > dayEnd}
+        _replaceFile(os.path.join(self._path, _ROLLUP_FILE), json.dumps(rollup), "w")
+        os.remove(rawFileName)
+
+    # returns the series keys in the store
+    def getSeries(self):
+        """Returns the list of series keys in the store"""
+
+        with self._lock:
+            return sorted(self._series)
+
+    # query the values of a series over a time range
+    def query(self, series, start=None, end=None, resolution=RESOLUTION_RAW):
+        """Returns the recorded values of a series in a time range
+
+        Parameters:
+        series -- series key (see getSeriesKey())
+        start -- start of the range in epoch seconds (defaults to the oldest record)
+        end -- end of the range in epoch seconds (defaults to now)
+        resolution -- RESOLUTION_RAW or RESOLUTION_HOURLY
+
+        Returns:
+        list of (timestamp, value) tuples for RESOLUTION_RAW or (timestamp, minimum, maximum, mean) tuples for RESOLUTION_HOURLY, oldest first
+        Note: raw records are only stored when a value changes (or every hour if unchanged) and do not include values not yet written to disk (see flush())
+        Note: hourly means are weighted by how long each value held in the hour
+        """
+
+        with self._lock:
+            seriesID = self._series.get(series)
+        if seriesID is None:
+            return []
+
+        end = time.time() if end is None else end
+        start = 0 if start is None else start
+
+        if resolution == RESOLUTION_HOURLY:
+            dirName, fileFormat, record = _HOURLY_DIR, _HOURLY_FILE_FORMAT, _HOURLY_RECORD
+        else:
+            dirName, fileFormat, record = _RAW_DIR, _RAW_FILE_FORMAT, _RAW_RECORD
+
+        # read only the files covering the time range
+        firstFile = time.strftime(fileFormat, time.gmtime(start))
+        lastFile = time.strftime(fileFormat, time.gmtime(end))
+        results = []
+        for fileName in sorted(os.listdir(os.path.join(self._path, dirName))):
+            if firstFile <= fileName <= lastFile:
+                results.extend(values[:1] + values[2:] for values in _readRecords(os.path.join(self._path, dirName, fileName), record) if values[1] == seriesID and start <= values[0] <= end)
+
+        results.sort(key=lambda values: values[0])
+        return results
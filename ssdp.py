@@ -13,8 +13,11 @@
 #   limitations under the License.
 
 import socket
+import selectors
+import time
 import http.client
 import io
+import logging
 
 class SSDPResponse(object):
     class _FakeSocket(io.BytesIO):
@@ -26,33 +29,123 @@ class SSDPResponse(object):
         self.location = r.getheader("location")
         self.usn = r.getheader("usn")
         self.st = r.getheader("st")
-        self.cache = r.getheader("cache-control").split("=")[1]
+        cache = r.getheader("cache-control", "")
+        self.cache = cache.split("=")[1] if "=" in cache else None
     def __repr__(self):
         return "<SSDPResponse({location}, {st}, {usn})>".format(**self.__dict__)
 
-def discover(service, timeout=5, retries=1, mx=3):
+def _open_socket(interface=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    if interface:
+        # send the M-SEARCH out of the specified interface and receive the responses on it
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        sock.bind((interface, 0))
+    sock.setblocking(False)
+    return sock
+
+def discover_iter(service, timeout=5, mx=3, retransmit=(0,), interfaces=None):
+    """Yields each SSDPResponse as it arrives until timeout seconds have passed.
+
+    retransmit -- offsets (in seconds from the start) at which the M-SEARCH is sent
+    interfaces -- IP addresses of the local interfaces to search on (default interface if None)
+    Only per-socket state is used - the global socket timeout is not touched.
+    """
     group = ("239.255.255.250", 1900)
     message = "\r\n".join([
         'M-SEARCH * HTTP/1.1',
         'HOST: {0}:{1}',
         'MAN: "ssdp:discover"',
         'ST: {st}','MX: {mx}','',''])
-    socket.setdefaulttimeout(timeout)
-    responses = {}
-    for _ in range(retries):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-        message_bytes = message.format(*group, st=service, mx=mx).encode('utf-8')
-        sock.sendto(message_bytes, group)
+    message_bytes = message.format(*group, st=service, mx=mx).encode('utf-8')
+    sel = selectors.DefaultSelector()
+    socks = [_open_socket(interface) for interface in (interfaces or [None])]
+    for sock in socks:
+        sel.register(sock, selectors.EVENT_READ)
+    seen = set()
+    start = time.monotonic()
+    deadline = start + timeout
+    sends = sorted(start + offset for offset in retransmit if offset < timeout)
+    try:
         while True:
+            now = time.monotonic()
+            while sends and sends[0] <= now:
+                sends.pop(0)
+                for sock in socks:
+                    try:
+                        sock.sendto(message_bytes, group)
+                    except OSError:
+                        pass
+            if now >= deadline:
+                break
+            wait = min([deadline] + sends[:1]) - now
+            for key, _ in sel.select(wait):
+                try:
+                    data = key.fileobj.recv(2048)
+                    response = SSDPResponse(data)
+                except (OSError, http.client.HTTPException, IndexError):
+                    continue
+                if response.location not in seen:
+                    seen.add(response.location)
+                    yield response
+    finally:
+        sel.close()
+        for sock in socks:
+            sock.close()
+
+class SSDPNotify(object):
+    def __init__(self, data):
+        start_line, _, rest = data.partition(b"\r\n")
+        if not start_line.startswith(b"NOTIFY"):
+            raise ValueError("not an SSDP NOTIFY message")
+        headers = http.client.parse_headers(io.BytesIO(rest))
+        self.location = headers.get("location")
+        self.usn = headers.get("usn")
+        self.nt = headers.get("nt")
+        self.nts = headers.get("nts")
+        cache = headers.get("cache-control", "")
+        self.cache = cache.split("=")[1] if "=" in cache else None
+    def __repr__(self):
+        return "<SSDPNotify({location}, {nt}, {nts}, {usn})>".format(**self.__dict__)
+
+def listen(callback, stop_event, interfaces=None, poll_interval=1.0):
+    """Calls callback with each SSDPNotify received on the SSDP multicast group until stop_event is set.
+
+    interfaces -- IP addresses of the local interfaces to join the group on (default interface if None)
+    """
+    group = ("239.255.255.250", 1900)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("", group[1]))
+    for interface in (interfaces or ["0.0.0.0"]):
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(group[0]) + socket.inet_aton(interface))
+    sock.settimeout(poll_interval)
+    try:
+        while not stop_event.is_set():
             try:
-                response = SSDPResponse(sock.recv(1024))
-                responses[response.location] = response
+                data = sock.recv(2048)
+                notify = SSDPNotify(data)
             except socket.timeout:
-                break
-    return list(responses.values())
+                continue
+            except (ValueError, http.client.HTTPException, IndexError):
+                continue
+            # keep listening if the callback fails
+            try:
+                callback(notify)
+            except Exception:
+                logging.getLogger(__name__).exception("Error in SSDP listen callback")
+    finally:
+        sock.close()
+
+def discover(service, timeout=5, retries=1, mx=3, interfaces=None):
+    retransmit = [i * timeout for i in range(retries)]
+    return list(discover_iter(service, timeout * retries, mx, retransmit, interfaces))
 
 # Example:
 # import ssdp
-# ssdp.discover("roku:ecp")
\ No newline at end of file
+# ssdp.discover("roku:ecp")
+# for response in ssdp.discover_iter("roku:ecp"):
+#     print(response)
@@ -0,0 +1,420 @@
+#!/usr/bin/python3
+"""
+Benchmark for the Venstar ColorTouch nodeserver against simulated thermostats
+Runs discovery, poll cycles, longPoll, and command handlers of venstar-poly.py with a stubbed
+polyinterface against thermostats simulated by venstar-sim.py, and saves the results as JSON
+With --startup, profiles the import and start time of the nodeserver process instead
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import socket
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import importlib.util
+import urllib.request
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# load a module from a script in the nodeserver directory (the scripts have hyphenated names)
+def loadScript(name, fileName):
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(_BASE_DIR, fileName))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# build a stand-in for the polyinterface module that counts driver reports instead of sending them to Polyglot
+def stubPolyinterface():
+
+    poly = types.ModuleType("polyinterface")
+    poly.LOGGER = logging.getLogger("venstar-bench")
+    poly.driverReports = 0
+
+    class Node(object):
+
+        drivers = []
+
+        def __init__(self, controller, primary, address, name):
+            self.controller = controller
+            self.parent = controller
+            self.primary = primary
+            self.address = address
+            self.name = name
+            # Note: like polyinterface, the drivers list is left shared with the class
+
+        def setDriver(self, driver, value, report=True, force=False, uom=None):
+            for d in self.drivers:
+                if d["driver"] == driver:
+                    d["value"] = value
+                    if uom is not None:
+                        d["uom"] = uom
+                    if report:
+                        self.reportDriver(d, report, force)
+                    break
+
+        def reportDriver(self, driver, report, force):
+            poly.driverReports += 1
+
+        def getDriver(self, dv):
+            return next((driver["value"] for driver in self.drivers if driver["driver"] == dv), None)
+
+    class Controller(Node):
+
+        def __init__(self, polyglot):
+            self.poly = polyglot
+            self.controller = self
+            self.parent = self
+            self.address = "controller"
+            self.primary = self.address
+            self.name = "Controller"
+            self.nodes = {}
+            self._nodes = {}
+            self.polyConfig = {"customData": {}, "customParams": {}, "shortPoll": 10, "longPoll": 60}
+
+        def addNode(self, node, update=False):
+            self.nodes[node.address] = node
+            return node
+
+        def updateNode(self, node):
+            pass
+
+        def saveCustomData(self, data):
+            pass
+
+        def addNotice(self, *args):
+            poly.LOGGER.debug("Notice: %s", args)
+
+        def removeNoticesAll(self):
+            pass
+
+    poly.Node = Node
+    poly.Controller = Controller
+    return poly
+
+# nearest-rank percentiles of a list of samples
+def percentiles(samples):
+
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    pick = lambda p: samples[min(len(samples) - 1, int(round(p / 100.0 * len(samples) + 0.5)) - 1)]
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": samples[-1], "mean": sum(samples) / len(samples)}
+
+# returns the peak resident set size of the process in MB
+def peakRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# benchmark run against one simulator instance
+class benchmarkRun(object):
+
+    def __init__(self, vp, poly, args, count):
+
+        self.vp = vp
+        self.poly = poly
+        self.args = args
+        self.count = count
+        self.statsURL = "http://{}:{}/sim/stats".format(args.address, args.port)
+        self.simulator = None
+
+    # start the simulator in a separate process so its CPU and memory aren't counted
+    def startSimulator(self):
+
+        command = [sys.executable, os.path.join(_BASE_DIR, "venstar-sim.py"), "-n", str(self.count), "-a", self.args.address, "-p", str(self.args.port),
+            "--latency", str(self.args.latency), "--jitter", str(self.args.jitter), "--error-rate", str(self.args.error_rate),
+            "--timeout-rate", str(self.args.timeout_rate), "--offline-rate", str(self.args.offline_rate)]
+        if not self.args.ssdp:
+            command.append("--no-ssdp")
+        self.simulator = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # wait for the first thermostat port to accept connections
+        deadline = time.time() + 30 + self.count / 100.0
+        while time.time() < deadline:
+            try:
+                self.requestCount()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("Simulator did not start")
+
+    def stopSimulator(self):
+        self.simulator.terminate()
+        self.simulator.wait()
+
+    # total number of HTTP requests the simulator has received
+    def requestCount(self):
+        with urllib.request.urlopen(self.statsURL, timeout=5) as response:
+            return json.loads(response.read()).get("requests", 0)
+
+    # run a function, measuring the wall time, CPU time, HTTP requests, and driver reports
+    def measure(self, function, *args):
+
+        requests = self.requestCount()
+        reports = self.poly.driverReports
+        cpu = time.process_time()
+        start = time.perf_counter()
+        function(*args)
+        return {
+            "seconds": time.perf_counter() - start,
+            "cpu_seconds": time.process_time() - cpu,
+            "requests": self.requestCount() - requests,
+            "driver_reports": self.poly.driverReports - reports,
+        }
+
+    # summarize a list of measurements
+    def summarize(self, samples):
+
+        return {
+            "cycles": len(samples),
+            "seconds": percentiles([sample["seconds"] for sample in samples]),
+            "cpu_seconds_per_cycle": sum(sample["cpu_seconds"] for sample in samples) / len(samples),
+            "requests_per_cycle": sum(sample["requests"] for sample in samples) / float(len(samples)),
+            "driver_reports_per_cycle": sum(sample["driver_reports"] for sample in samples) / float(len(samples)),
+        }
+
+    # poll the state of every thermostat once in the poll worker pool, as the poll scheduler does when all are due
+    def pollCycle(self, controller):
+
+        futures = [controller._pollExecutor.submit(controller._pollThermostat, node) for node in controller.getThermostatNodes()]
+        for future in futures:
+            future.result()
+
+    # send a setpoint command to each of the thermostats, measuring each until it has been sent and confirmed
+    def commandCycle(self, controller, samples):
+
+        for node in controller.getThermostatNodes():
+            if node.getDriver("GV0") == 1:
+                setpoint = 80 if node.getDriver("CLISPC") != 80 else 79
+                sample = self.measure(self.sendCommand, node, {"cmd": "SET_CLISPC", "value": str(setpoint)})
+                samples.append(sample)
+
+    def sendCommand(self, node, command):
+        node.commands[command["cmd"]](node, command)
+        node.flushControls()
+
+    def run(self):
+
+        self.startSimulator()
+        try:
+            vp = self.vp
+            controller = vp.Controller(None)
+
+            # unless the thermostats are discovered with SSDP, return the simulated thermostats from the SSDP discovery
+            if not self.args.ssdp:
+                hostNames = ["{}:{}".format(self.args.address, self.args.port + n) for n in range(self.count)]
+                thermostats = [{"id": "0023a7{:06x}".format(n), "name": "Thermostat {}".format(n + 1), "type": "residential", "hostname": hostName} for n, hostName in enumerate(hostNames)]
+                vp.api.iterDiscoverThermostats = lambda *args: iter(thermostats)
+
+            result = {"thermostats": self.count}
+            result["discover"] = self.measure(controller.discover)
+            result["discover"]["nodes"] = len(controller.nodes)
+
+            result["poll"] = self.summarize([self.measure(self.pollCycle, controller) for n in range(self.args.cycles)])
+
+            # count the driver updates suppressed by a poll of the (unchanged) simulated thermostats
+            suppressed = controller.getSuppressedUpdates()
+            self.pollCycle(controller)
+            result["poll"]["suppressed_updates"] = controller.getSuppressedUpdates() - suppressed
+            result["longpoll"] = self.summarize([self.measure(controller.longPoll) for n in range(max(self.args.cycles // 2, 1))])
+
+            samples = []
+            self.commandCycle(controller, samples)
+            result["commands"] = self.summarize(samples) if samples else {}
+
+            result["rss_mb"] = peakRSS()
+
+            controller.stop()
+            return result
+
+        finally:
+            self.stopSimulator()
+
+# marker written to stderr by the startup child process before the nodeserver is loaded
+_STARTUP_MARKER = "venstar-bench: loading nodeserver"
+
+# load and start the nodeserver without thermostats and report the timings (runs in the child process for --startup)
+def startupChild():
+
+    poly = stubPolyinterface()
+    sys.modules["polyinterface"] = poly
+    sys.path.insert(0, _BASE_DIR)
+
+    sys.stderr.write(_STARTUP_MARKER + "\n")
+    sys.stderr.flush()
+
+    start = time.perf_counter()
+    vp = loadScript("venstar_poly", "venstar-poly.py")
+    imported = time.perf_counter()
+
+    # start the controller as Polyglot would, with a specified hostname so the SSDP listener isn't started and no history is written
+    controller = vp.Controller(None)
+    controller.polyConfig["customParams"] = {"hostname": "127.0.0.1", "historydays": "0"}
+    controller.start()
+    started = time.perf_counter()
+    controller.stop()
+
+    print(json.dumps({"import_seconds": imported - start, "start_seconds": started - imported}))
+
+# parse the -X importtime output of the modules imported by the nodeserver into cumulative times (in seconds) for each top-level import
+def parseImportTimes(stderr):
+
+    imports = {}
+    lines = stderr.splitlines()
+    if _STARTUP_MARKER in lines:
+        lines = lines[lines.index(_STARTUP_MARKER) + 1:]
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        if not name.startswith(" "):
+            continue
+        name = name[1:]
+        if not name.startswith(" "):
+            imports[name] = imports.get(name, 0.0) + int(fields[1]) / 1000000.0
+
+    return imports
+
+# profile the startup of the nodeserver process
+def startupRun(args):
+
+    samples = []
+    imports = {}
+    for n in range(args.startup_runs):
+        start = time.perf_counter()
+        child = subprocess.run([sys.executable, "-X", "importtime", os.path.abspath(__file__), "--startup-child"], capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        if child.returncode != 0:
+            raise RuntimeError("Startup child process failed: " + child.stderr[-2000:])
+        sample = json.loads(child.stdout.strip().splitlines()[-1])
+        sample["wall_seconds"] = wall
+        samples.append(sample)
+        for name, seconds in parseImportTimes(child.stderr).items():
+            imports.setdefault(name, []).append(seconds)
+
+    # summarize the timings and the slowest imports by median time
+    median = lambda values: sorted(values)[len(values) // 2]
+    return {
+        "runs": len(samples),
+        "wall_seconds": percentiles([sample["wall_seconds"] for sample in samples]),
+        "import_seconds": percentiles([sample["import_seconds"] for sample in samples]),
+        "start_seconds": percentiles([sample["start_seconds"] for sample in samples]),
+        "imports": [{"module": name, "seconds": median(times)} for name, times in sorted(imports.items(), key=lambda item: median(item[1]), reverse=True)[:10]],
+    }
+
+# compare the results to a baseline, returning a list of regressions
+def compareResults(results, baseline, tolerance):
+
+    regressions = []
+    baseResults = {result["thermostats"]: result for result in baseline["results"]}
+    for result in results:
+        base = baseResults.get(result["thermostats"])
+        if base is None:
+            continue
+        for section in ("poll", "longpoll", "commands"):
+            if result.get(section) and base.get(section):
+                now, then = result[section]["seconds"]["p50"], base[section]["seconds"]["p50"]
+                if now > then * (1.0 + tolerance):
+                    regressions.append("{} thermostats {} p50 {:.3f}s vs {:.3f}s".format(result["thermostats"], section, now, then))
+        if result["discover"]["seconds"] > base["discover"]["seconds"] * (1.0 + tolerance):
+            regressions.append("{} thermostats discover {:.3f}s vs {:.3f}s".format(result["thermostats"], result["discover"]["seconds"], base["discover"]["seconds"]))
+
+    return regressions
+
+# Main function to run the benchmark from the command line
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the Venstar ColorTouch nodeserver against simulated thermostats.")
+    parser.add_argument("-n", "--counts", default="10,50,200", help="comma separated numbers of thermostats to benchmark (default 10,50,200)")
+    parser.add_argument("-c", "--cycles", type=int, default=10, help="number of poll cycles per run (default 10)")
+    parser.add_argument("-a", "--address", default="127.0.0.1", help="address for the simulated thermostats (default 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=18000, help="port for the first simulated thermostat (default 18000)")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean thermostat response delay in seconds (default 0.05)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="maximum random variation of the response delay in seconds (default 0.02)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests returning HTTP 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of requests never answered")
+    parser.add_argument("--offline-rate", type=float, default=0.0, help="fraction of thermostats that are offline")
+    parser.add_argument("--ssdp", action="store_true", help="discover the simulated thermostats with SSDP")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="file to save the results to (default bench_output.json)")
+    parser.add_argument("--baseline", help="results file from a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown vs. the baseline before failing (default 0.2)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log the nodeserver messages")
+    parser.add_argument("--startup", action="store_true", help="profile the import and start time of the nodeserver instead")
+    parser.add_argument("--startup-runs", type=int, default=5, help="number of nodeserver processes started for --startup (default 5)")
+    parser.add_argument("--startup-target", type=float, default=0.5, help="maximum median import and start time in seconds for --startup (default 0.5)")
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.startup_child:
+        startupChild()
+        sys.exit(0)
+
+    # profile the startup and fail if the import and start time is over the target
+    if args.startup:
+        result = startupRun(args)
+        total = result["import_seconds"]["p50"] + result["start_seconds"]["p50"]
+        print("Startup: import p50 {:.3f}s, start p50 {:.3f}s, process p50 {:.3f}s (target {:.3f}s)".format(
+            result["import_seconds"]["p50"], result["start_seconds"]["p50"], result["wall_seconds"]["p50"], args.startup_target))
+        for entry in result["imports"]:
+            print("  {:<30} {:.3f}s".format(entry["module"], entry["seconds"]))
+        with open(args.output, "w") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "host": socket.gethostname(), "python": platform.python_version(),
+                "parameters": vars(args), "startup": result}, f, indent=2)
+        print("Results saved to {}".format(args.output))
+        if total > args.startup_target:
+            print("REGRESSION: startup {:.3f}s over target {:.3f}s".format(total, args.startup_target))
+        sys.exit(1 if total > args.startup_target else 0)
+
+    # load the nodeserver with the stubbed polyinterface
+    poly = stubPolyinterface()
+    sys.modules["polyinterface"] = poly
+    sys.path.insert(0, _BASE_DIR)
+    vp = loadScript("venstar_poly", "venstar-poly.py")
+    loadScript("venstar_sim", "venstar-sim.py").raiseFileLimit()
+
+    results = []
+    failures = []
+    for count in [int(count) for count in args.counts.split(",")]:
+        print("Benchmarking {} thermostat(s)...".format(count), flush=True)
+        result = benchmarkRun(vp, poly, args, count).run()
+        results.append(result)
+        print("  discover {:.2f}s, poll p50 {:.3f}s p99 {:.3f}s ({:.0f} requests, {:.0f} driver reports per cycle), longPoll p50 {:.3f}s, command p50 {:.3f}s".format(
+            result["discover"]["seconds"], result["poll"]["seconds"]["p50"], result["poll"]["seconds"]["p99"], result["poll"]["requests_per_cycle"],
+            result["poll"]["driver_reports_per_cycle"], result["longpoll"]["seconds"]["p50"], result["commands"].get("seconds", {}).get("p50", 0.0)), flush=True)
+
+        # polls of thermostats whose state didn't change must be counted as suppressed driver updates
+        if result["poll"]["driver_reports_per_cycle"] == 0 and result["poll"]["suppressed_updates"] == 0:
+            failures.append("{} thermostat(s): identical polls not counted as suppressed driver updates".format(count))
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("Results saved to {}".format(args.output))
+
+    for failure in failures:
+        print("FAILED: " + failure)
+
+    # fail if any results regressed from the baseline
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compareResults(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        sys.exit(1 if regressions or failures else 0)
+    sys.exit(1 if failures else 0)
@@ -4,11 +4,16 @@ Polglot v2 NodeServer for Venstar ColorTouch Thermostats
 by Goose66 (W. Randy King) kingwrandy@gmail.com
 """
 import sys
+import os
 import re
 import time
+import random
+import threading
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import venstarapi as api
-import socket
-from ipaddress import IPv4Address
+import history
 import polyinterface
 
 LOGGER = polyinterface.LOGGER
@@ -24,6 +29,7 @@ ISY_TSTAT_MODE_UOM = 67 # UOM for thermostat mode
 ISY_TSTAT_HCS_UOM = 66 # UOM for thermostat heat/cool state
 ISY_TSTAT_FS_UOM = 68 # UOM for fan mode
 ISY_TSTAT_FRS_UOM = 80 # UOM for fan runstate
+ISY_MINUTES_UOM = 45 # UOM for runtimes (minutes)
 
 # values for thermostat mode
 IX_TSTAT_MODE_OFF = 0
@@ -39,9 +45,117 @@ IX_TSTAT_SCHED_MODE_INACTIVE = 255
 # custom parameter values for this nodeserver
 PARAM_HOSTNAMES = "hostname"
 PARAM_PIN = "pin"
+PARAM_STATE_CACHE_TTL = "statecachettl"
+PARAM_INTERFACES = "interfaces"
+PARAM_METRICS_PORT = "metricsport"
+PARAM_HISTORY_DAYS = "historydays"
+PARAM_POOL_SIZE = "poolsize"
+PARAM_POOL_SIZE_PER_HOST = "poolsizeperhost"
+PARAM_KEEPALIVE_TIMEOUT = "keepalivetimeout"
+PARAM_CONNECT_TIMEOUT = "connecttimeout"
+PARAM_READ_TIMEOUT = "readtimeout"
+
+# default age (in seconds) of polled thermostat state that command handlers may use without querying the thermostat
+DEFAULT_STATE_CACHE_TTL = 15.0
+
+# settings for the local state history store
+# Note: raw state changes are kept for the history days, then downsampled to hourly values kept for a year
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "history")
+DEFAULT_HISTORY_DAYS = 7
+HISTORY_HOURLY_DAYS = 365
+HISTORY_STATE_FIELDS = ("spacetemp", "heattemp", "cooltemp", "hum", "mode", "away", "fan", "state", "fanstate")
+HISTORY_SENSOR_FIELDS = ("temp", "battery")
+
+# thermostat state fields reflected in the thermostat node drivers (watched in the state feed)
+THERMOSTAT_STATE_FIELDS = ("spacetemp", "heattemp", "cooltemp", "hum", "mode", "away", "fan", "state", "fanstate", "schedulepart", "tempunits", api.STATE_FIELD_ONLINE)
+
+# thermostat node drivers updated from the thermostat state
+THERMOSTAT_STATE_DRIVERS = ("GV0", "ST", "CLISPH", "CLISPC", "CLIMD", "CLIFS", "CLIHCS", "CLIFRS", "CLIHUM", "CLISMD")
+
+# version of the thermostat metadata saved in polyglot custom data
+# Note: version 0 was a "hostname;type;tempunit" string
+METADATA_VERSION = 1
+
+# number of days of runtime records kept for each thermostat
+RUNTIME_HISTORY_DAYS = 7
+
+# drivers for the runtime of each HVAC stage from the runtime records
+RUNTIME_DRIVERS = (
+    ("GV1", "heat1"),
+    ("GV2", "heat2"),
+    ("GV3", "cool1"),
+    ("GV4", "cool2"),
+    ("GV5", "aux1"),
+    ("GV6", "aux2"),
+    ("GV7", "fc"),
+)
+
+# time (in seconds) to collect commands for a thermostat before sending them in a single call
+COMMAND_COALESCE_WINDOW = 0.5
+
+# maximum number of thermostats queried concurrently by the poll scheduler
+MAX_POLL_WORKERS = 16
+
+# settings for the adaptive poll scheduler (in seconds unless noted)
+# Note: idle and active intervals are multiples of the configured shortPoll value
+POLL_SCHEDULER_TICK = 0.5 # how often the scheduler checks for thermostats due to be polled
+POLL_IDLE_FACTOR = 3.0 # poll interval multiplier when the HVAC and fan are idle
+POLL_ACTIVE_FACTOR = 0.5 # poll interval multiplier when the HVAC or fan is running
+POLL_INTERVAL_COMMAND = 2.0 # poll interval right after a command
+POLL_COMMAND_BOOST_TIME = 30.0 # how long after a command to poll at the command interval
+POLL_BACKOFF_MAX = 300.0 # maximum poll interval for thermostats that are not responding
+POLL_JITTER = 0.2 # random jitter applied to each poll interval (+/- fraction)
+
+# Base node class for thermostat and sensor nodes that only reports driver values that have changed
+class VenstarNode(polyinterface.Node):
+
+    suppressedUpdates = 0
+    _reportedDrivers = None
+    _driverIndex = None
+
+    def __init__(self, controller, primary, addr, name):
+        super(VenstarNode, self).__init__(controller, primary, addr, name)
+
+        # give the node its own copy of the class drivers, indexed by driver name
+        # Note: the drivers list is kept for polyinterface, and the index references the same dictionaries
+        self.drivers = [dict(driver) for driver in self.drivers]
+        self._driverIndex = {driver["driver"]: driver for driver in self.drivers}
+
+        # drivers reported since the node was created - each driver is reported at least once
+        self._reportedDrivers = set()
+
+    # update the driver value, reporting it to Polyglot only if the value has changed
+    def updateDriver(self, driver, value, forceReport=False):
+
+        if forceReport or driver not in self._reportedDrivers or self.getDriver(driver) != value:
+            self.setDriver(driver, value, True, forceReport)
+            self._reportedDrivers.add(driver)
+        else:
+            self.suppressedUpdates += 1
+
+    # override setDriver to locate the driver from the index
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+
+        d = self._driverIndex.get(driver)
+        if d is not None:
+            d["value"] = value
+            if uom is not None:
+                d["uom"] = uom
+            if report:
+                self.reportDriver(d, report, force)
+
+    # override getDriver to return the last setDriver() value instead of reading from poly.config
+    def getDriver(self, dv):
+        driver = self._driverIndex.get(dv)
+        return None if driver is None else driver["value"]
+
+    # set the UOM of the temperature drivers of the node for the temp unit (0-F or 1-C)
+    def setTempDriverUOMs(self, drivers, tempUnit):
+        for driver in drivers:
+            self._driverIndex[driver]["uom"] = ISY_TEMP_C_UOM if tempUnit == 1 else ISY_TEMP_F_UOM
 
 # Node class for temperature sensor
-class Sensor(polyinterface.Node):
+class Sensor(VenstarNode):
 
     id = "SENSOR"
     hint = [0x01, 0x03, 0x03, 0x00] # Residential/Sensor/Climate Sensor
@@ -53,7 +167,7 @@ class Sensor(polyinterface.Node):
         # override the parent node with the thermostat node (defaults to controller)
         self.parent = self.controller.nodes[self.primary]
 
-        # set the temp unit before calling the parent class init()
+        # setup the temp unit for the drivers
         self.setTempUnit(tempUnit)
 
     # Setup the termostat node for the correct temperature unit (0-F or 1-C)
@@ -61,9 +175,7 @@ class Sensor(polyinterface.Node):
         
         # update the drivers in the node to the correct UOM
         # this is so the numbers show up in the Admin Console with the right unit
-        for driver in self.drivers:
-            if driver["driver"] in ("ST"):
-                driver["uom"] = ISY_TEMP_C_UOM if tempUnit == 1 else ISY_TEMP_F_UOM
+        self.setTempDriverUOMs(("ST",), tempUnit)
         
     drivers = [
         {"driver": "ST", "value": 0.0, "uom": ISY_TEMP_F_UOM},
@@ -71,7 +183,7 @@ class Sensor(polyinterface.Node):
     ]
 
 # Node class for thermostat
-class Thermostat(polyinterface.Node):
+class Thermostat(VenstarNode):
 
     id = "THERMOSTAT"
     hint = [0x01, 0x0C, 0x01, 0x00] # Residential/HVAC/Thermostat
@@ -79,31 +191,45 @@ class Thermostat(polyinterface.Node):
     _hostName = ""
     _type = ""
     _conn = None
+    _stateSubscription = None
+    _lastAlertStates = None
+    _lastSensorStates = None
+    _lastSensors = None
+    _pendingControls = None
+    _inFlightControls = None
+    _commandLock = None
+    _stateLock = None
+    _commandTimer = None
+    _runtimes = None
+    _lastRuntimeTS = 0
+    _metadata = None
     
     # Override init to handle temp units
     def __init__(self, controller, primary, addr, name, hostName=None, type=None, tempUnit=None):
 
         if hostName is None:
         
-            # retrieve the thermostat properties from polyglot custom data
+            # retrieve the thermostat properties from the metadata in polyglot custom data
             # Note: use controller and addr parameters instead of self.controller and self.address
             # because parent class init() has not been called yet
-            cData = controller.getCustomData(addr).split(";")
-            self._hostName = cData[0]
-            self._type = cData[1]
-            self.tempUnit = int(cData[2])
+            self._metadata = parseMetadata(controller.getCustomData(addr))
+            self._hostName = self._metadata["hostName"]
+            self._type = self._metadata["type"]
+            self.tempUnit = int(self._metadata["tempUnit"])
 
         else:
+            self._metadata = {}
             self._hostName = hostName
             self._type = type
             self.tempUnit = tempUnit
 
-        # setup the temp unit before calling the parent class init()
-        self.setTempUnit(self.tempUnit)
-
         # call the parent class init
         super(Thermostat, self).__init__(controller, addr, addr, name) # send own address as primary
 
+        # setup the node id and drivers for the temp unit
+        # Note: the drivers are copied for each node in the parent class init(), so this has to be done after
+        self.setTempUnit(self.tempUnit)
+
         # make the thermostat a primary node
         # Note: this is to support grouping of child nodes, e.g., sensors
         self.isPrimary = True
@@ -111,19 +237,102 @@ class Thermostat(polyinterface.Node):
         # create a connection object in the API for the the thermostat 
         self._conn = api.thermostatConnection(self._hostName, logger=LOGGER)
 
+        # queue for control changes to be sent to the thermostat together
+        self._pendingControls = {}
+        self._inFlightControls = {}
+        self._commandLock = threading.Lock()
+        self._stateLock = threading.Lock()
+
+        # daily runtime records, oldest first
+        self._runtimes = deque(maxlen=RUNTIME_HISTORY_DAYS)
+
+        # update the drivers from changes in the thermostat state
+        self._stateSubscription = self.controller.stateFeed.subscribe(self._stateChanged, THERMOSTAT_STATE_FIELDS, self.address)
+
         # store instance variables in polyglot custom data
         self.saveProperties()
 
+    # change the hostname (e.g., new IP address) of the thermostat
+    def setHostName(self, hostName):
+
+        self._hostName = hostName
+        self._conn.setHostName(hostName)
+        self.saveProperties()
+
+        # poll the thermostat at the new hostname right away
+        self.controller.boostPolling(self.address)
+
+    # returns the hostname of the thermostat
+    def getHostName(self):
+        return self._hostName
+
+    # point the API connection at the resolved IP address of the hostname, without changing the hostname
+    def setConnectionAddress(self, address):
+
+        if self._conn.getHostName() != address:
+            LOGGER.info("Hostname %s for thermostat %s resolved to %s.", self._hostName, self.name, address)
+            self._conn.setHostName(address)
+
+            # poll the thermostat at the new address right away
+            self.controller.boostPolling(self.address)
+
+    # returns the API connection for the thermostat
+    def getConnection(self):
+        return self._conn
+
     # save object properties to custom data
     def saveProperties(self):
 
-            # store instance variables in polyglot custom data
-            cData = ";".join([
-                self._hostName,
-                self._type,
-                str(self.tempUnit),
-            ])
-            self.controller.addCustomData(self.address, cData)
+            # store instance variables in the metadata in polyglot custom data
+            with self.controller.customDataLock:
+                self._metadata.update({
+                    "version": METADATA_VERSION,
+                    "hostName": self._hostName,
+                    "type": self._type,
+                    "tempUnit": self.tempUnit,
+                })
+            self.controller.addCustomData(self.address, self._metadata)
+
+    # save the thermostat info queried in discovery to the metadata
+    def saveDiscoveryInfo(self, thermoInfo, usn=None, location=None):
+
+        with self.controller.customDataLock:
+            self._metadata.update({
+                "apiVersion": thermoInfo.get("api_ver"),
+                "model": thermoInfo.get("model"),
+                "firmware": thermoInfo.get("firmware"),
+                "sensors": [sensor["name"] for sensor in thermoInfo.get("sensors", [])],
+                "usn": usn,
+                "location": location,
+                "discoveredTime": time.time(),
+            })
+        self.saveProperties()
+
+    # returns True if the thermostat was discovered before with the same SSDP USN and location
+    def isDiscoveryUnchanged(self, usn, location):
+        return usn is not None and self._metadata.get("usn") == usn and self._metadata.get("location") == location
+
+    # save the last known driver values to the metadata
+    # Note: called from the poll worker threads, so the metadata is changed with the custom data lock held
+    def saveLastDrivers(self, values):
+
+        with self.controller.customDataLock:
+            self._metadata["lastDrivers"] = dict(self._metadata.get("lastDrivers", {}), **values)
+            self._metadata["lastStateTime"] = time.time()
+
+    # report the last known driver values from the metadata, e.g., at startup before the thermostat is polled
+    # Note: the online driver (GV0) is left for the first poll, since the thermostat has not responded yet
+    def reportLastDrivers(self):
+
+        lastDrivers = self._metadata.get("lastDrivers", {})
+        for driver in lastDrivers:
+            if driver != "GV0":
+                self.updateDriver(driver, lastDrivers[driver])
+
+        lastSensorDrivers = self._metadata.get("lastSensorDrivers", {})
+        for node in self.controller.getChildNodes(self.address):
+            for driver, value in lastSensorDrivers.get(node.name, {}).items():
+                node.updateDriver(driver, value)
 
     # Setup the termostat node for the correct temperature unit (0-F or 1-C)
     def setTempUnit(self, tempUnit):
@@ -137,9 +346,7 @@ class Thermostat(polyinterface.Node):
             
         # update the drivers in the node to the correct UOM
         # this is so the numbers show up in the Admin Console with the right unit
-        for driver in self.drivers:
-            if driver["driver"] in ("ST", "CLISPH", "CLISPC"):
-                driver["uom"] = ISY_TEMP_C_UOM if tempUnit == 1 else ISY_TEMP_F_UOM
+        self.setTempDriverUOMs(("ST", "CLISPH", "CLISPC"), tempUnit)
 
     # Change the temperature unit for the thermostat node and update the ISY
     def changeTempUnits(self, tempUnit):
@@ -150,16 +357,9 @@ class Thermostat(polyinterface.Node):
         # update the node to Polyglot and the  ISY
         self.controller.updateNode(self)
 
-        # spin through the child nodes of this thermostat and update the tempunit
-        for addr in self.controller.nodes:
-
-            # ignore the controller and this thermostat node
-            if addr != self.address and addr != self.controller.address:
-
-                # if the device is a Sensor node with this thermostat as the primary, change its temp unit
-                node = self.controller.nodes[addr]
-                if node.id == "SENSOR" and node.primary == self.address:
-                    node.setTempUnit(tempUnit)
+        # change the temp unit of the sensor nodes of this thermostat
+        for node in self.controller.getChildNodes(self.address):
+            node.setTempUnit(tempUnit)
 
         # save the changed temp unit back to custom data
         self.tempUnit = tempUnit
@@ -171,42 +371,40 @@ class Thermostat(polyinterface.Node):
         LOGGER.info("Increase or decrease temperature of %s in command handler: %s.", self.name, str(command))
 
         # Get the state values for the thermostat since we are incrementing setpoints
-        thermostatState = self._conn.getThermostatState()
+        # Note: uses the state from the last poll if it is fresh enough
+        thermostatState = self._conn.getThermostatState(maxAge=self.controller.stateCacheTTL)
 
         # if the thermostat is online
         if thermostatState:
-    
-            # get the current thermostat settings
-            sph = thermostatState["heattemp"]
-            spc = thermostatState["cooltemp"]
-            mode = thermostatState["mode"]
-            away = (thermostatState["away"] == 1)
-            cmd = command["cmd"]
-
-            # determine the setpoint to increase based on the mode
-            if away:
-                LOGGER.warning("Setpoint(s) not adjusted for thermostat in Away mode.")
-            elif mode == api.THERMO_MODE_OFF:
-                LOGGER.warning("Setpoint(s) not adjusted for thermostat in Off mode.")
-            else:
-                if mode in (api.THERMO_MODE_HEAT, api.THERMO_MODE_AUTO):
-                    if cmd == "BRT":
-                        sph += 1.0
-                    else:
-                        sph -= 1.0
-                if mode in (api.THERMO_MODE_COOL, api.THERMO_MODE_AUTO):
-                    if cmd == "BRT":
-                        spc += 1.0
-                    else:
-                        spc -= 1.0
-
-                # call the controls API to set the new setpoints
-                if self._conn.setThermostatControls(heattemp=sph, cooltemp=spc):
-                    self.setDriver("CLISPH", sph)
-                    self.setDriver("CLISPC", spc)
 
+            with self._commandLock:
+    
+                # get the current thermostat settings, including any changes queued or being sent
+                sph = self._getControl("heattemp", thermostatState)
+                spc = self._getControl("cooltemp", thermostatState)
+                mode = self._getControl("mode", thermostatState)
+                away = (thermostatState["away"] == 1)
+                cmd = command["cmd"]
+
+                # determine the setpoint to increase based on the mode
+                if away:
+                    LOGGER.warning("Setpoint(s) not adjusted for thermostat in Away mode.")
+                elif mode == api.THERMO_MODE_OFF:
+                    LOGGER.warning("Setpoint(s) not adjusted for thermostat in Off mode.")
                 else:
-                    LOGGER.error("Call to API setThermostatControls() failed in %s command handler.", cmd)
+                    if mode in (api.THERMO_MODE_HEAT, api.THERMO_MODE_AUTO):
+                        if cmd == "BRT":
+                            sph += 1.0
+                        else:
+                            sph -= 1.0
+                    if mode in (api.THERMO_MODE_COOL, api.THERMO_MODE_AUTO):
+                        if cmd == "BRT":
+                            spc += 1.0
+                        else:
+                            spc -= 1.0
+
+                    # queue the new setpoints to be sent to the thermostat
+                    self.queueControls(heattemp=sph, cooltemp=spc)
 
     # Set the thermostat heat setpoint to the specified value
     def cmd_set_sp(self, command):
@@ -214,42 +412,39 @@ class Thermostat(polyinterface.Node):
         LOGGER.info("Set the setpoints for %s in command handler: %s", self.name, str(command))
 
         # Get the state values for the thermostat since we have to specify both setpoint values
-        thermostatState = self._conn.getThermostatState()
+        thermostatState = self._conn.getThermostatState(maxAge=self.controller.stateCacheTTL)
 
         # if the thermostat is online
         if thermostatState:
-    
-            # get the current thermostat settings
-            sph = thermostatState["heattemp"]
-            spc = thermostatState["cooltemp"]
-            mode = thermostatState["mode"]
-            setpointDelta = thermostatState["setpointdelta"]
-            away = (thermostatState["away"] == 1)
-            cmd = command["cmd"]
-
-            # can't change settings while in away mode
-            if away:
-                LOGGER.warning("Setpoint(s) not adjusted for thermostat in Away mode.")
-            else:
 
-                # replace setpoint with the specified value based on the command 
-                if cmd == "SET_CLISPH":
-                    sph = float(command["value"])
+            with self._commandLock:
+    
+                # get the current thermostat settings, including any changes queued or being sent
+                sph = self._getControl("heattemp", thermostatState)
+                spc = self._getControl("cooltemp", thermostatState)
+                mode = self._getControl("mode", thermostatState)
+                setpointDelta = thermostatState["setpointdelta"]
+                away = (thermostatState["away"] == 1)
+                cmd = command["cmd"]
+
+                # can't change settings while in away mode
+                if away:
+                    LOGGER.warning("Setpoint(s) not adjusted for thermostat in Away mode.")
                 else:
-                    spc = float(command["value"])
 
-                # make sure spc > sph by setpoint delta degrees if in auto mode
-                if mode == api.THERMO_MODE_AUTO and (spc - sph) < setpointDelta:
-                    LOGGER.warning("Difference between heat and cool setpoint(s) must be greater than or equal to %d degrees for thermostat in Auto mode.", setpointDelta)
-                else:
-                    
-                    # call the controls API to set the new setpoints
-                    if self._conn.setThermostatControls(heattemp=sph, cooltemp=spc):
-                        self.setDriver("CLISPH", sph)
-                        self.setDriver("CLISPC", spc)
+                    # replace setpoint with the specified value based on the command 
+                    if cmd == "SET_CLISPH":
+                        sph = float(command["value"])
+                    else:
+                        spc = float(command["value"])
 
+                    # make sure spc > sph by setpoint delta degrees if in auto mode
+                    if mode == api.THERMO_MODE_AUTO and (spc - sph) < setpointDelta:
+                        LOGGER.warning("Difference between heat and cool setpoint(s) must be greater than or equal to %d degrees for thermostat in Auto mode.", setpointDelta)
                     else:
-                        LOGGER.error("Call to API setThermostatControls() failed in %s command handler.", cmd)
+                        
+                        # queue the new setpoints to be sent to the thermostat
+                        self.queueControls(heattemp=sph, cooltemp=spc)
 
     # Set the thermostat mode to the specified value
     def cmd_set_mode(self, command):
@@ -257,25 +452,29 @@ class Thermostat(polyinterface.Node):
         LOGGER.info("Set the thermostat mode for %s in command handler: %s", self.name, str(command))
 
         # Get the state values for the thermostat since we have to specify both setpoint values
-        thermostatState = self._conn.getThermostatState()
+        thermostatState = self._conn.getThermostatState(maxAge=self.controller.stateCacheTTL)
 
         # if the thermostat is online
         if thermostatState:
     
             # get the current thermostat settings
-            sph = thermostatState["heattemp"]
-            spc = thermostatState["cooltemp"]
             away = (thermostatState["away"] == 1)
             newMode = int(command.get("value"))
 
             # if new mode is Away mode, then call the API to set the away mode
             if newMode == IX_TSTAT_MODE_AWAY:
+
+                # send any queued changes first, since controls can't be changed in away mode
+                self.flushControls()
     
                 # call the settings API to turn on away mode
                 if not self._conn.setThermostatSettings(api.THERMO_SETTING_AWAY_STATE, 1):
                     LOGGER.error("Call to API setThermostatSettings() failed in SET_CLIMD command handler.")
                     return
 
+                self.setDriver("CLIMD", newMode)
+                self.commandCompleted()
+
             else:
                 
                 # if the thermostat is currently in away mode then take the thermostat out of away mode before setting new mode
@@ -286,12 +485,11 @@ class Thermostat(polyinterface.Node):
                         LOGGER.error("Call to API setThermostatSettings() failed in SET_CLIMD command handler.")
                         return
             
-                # call the controls API to set the thermostat mode
-                if not self._conn.setThermostatControls(mode=newMode, heattemp=sph, cooltemp=spc):
-                    LOGGER.error("Call to API setThermostatControls() failed in SET_CLIMD command handler.")
-                    return
-            
-            self.setDriver("CLIMD", newMode)
+                # queue the new mode (with the current setpoints) to be sent to the thermostat
+                with self._commandLock:
+                    sph = self._getControl("heattemp", thermostatState)
+                    spc = self._getControl("cooltemp", thermostatState)
+                    self.queueControls(mode=newMode, heattemp=sph, cooltemp=spc)
 
     # Set the thermostat mode to the specified value
     def cmd_set_fan(self, command):
@@ -299,7 +497,7 @@ class Thermostat(polyinterface.Node):
         LOGGER.info("Set the fan mode for %s in command handler: %s", self.name, str(command))
 
         # Get the state values for the thermostat since we can't modify the fan when in away mode
-        thermostatState = self._conn.getThermostatState()
+        thermostatState = self._conn.getThermostatState(maxAge=self.controller.stateCacheTTL)
 
         # if the thermostat is online
         if thermostatState:
@@ -313,12 +511,9 @@ class Thermostat(polyinterface.Node):
                 LOGGER.warning("Fan mode not adjusted for thermostat in Away mode.")
             else:
         
-                # call the controls API to set fan mode
-                if self._conn.setThermostatControls(fan=fan):
-                    self.setDriver("CLIFS", fan)
-
-                else:
-                    LOGGER.error("Call to API setThermostatControls() failed in SET_CLIFS command handler.")
+                # queue the new fan mode to be sent to the thermostat
+                with self._commandLock:
+                    self.queueControls(fan=fan)
 
     # Set the schedule mode on
     def cmd_set_sched(self, command):
@@ -326,7 +521,7 @@ class Thermostat(polyinterface.Node):
         LOGGER.info("Set schedule mode on for %s in command handler: %s", self.name, str(command))
 
         # Get the state values for the thermostat since we can't modify the fan when in away mode
-        thermostatState = self._conn.getThermostatState()
+        thermostatState = self._conn.getThermostatState(maxAge=self.controller.stateCacheTTL)
 
         # if the thermostat is online
         if thermostatState:
@@ -342,113 +537,283 @@ class Thermostat(polyinterface.Node):
         
                 schedMode = 1 if cmd == "SCHED_ON" else 0
 
+                # send any queued changes first so they aren't overridden by the schedule
+                self.flushControls()
+
                 # call the settings API to set the schedule mode
                 if self._conn.setThermostatSettings(api.THERMO_SETTING_SCHEDULE_STATE, schedMode):
                     
                     # update the schedule mode driver
                     self.setDriver("CLISMD", IX_TSTAT_SCHED_MODE_ACTIVE if schedMode == 1 else IX_TSTAT_SCHED_MODE_INACTIVE)
+                    self.commandCompleted()
 
                 else:
                     LOGGER.error("Call to API setThermostatSettings() failed in %s command handler.", cmd)
 
-    # update the states for this thermostat
+    # returns the value of a control, including any change queued or being sent, otherwise from the thermostat state
+    # Note: must be called with the command lock held
+    def _getControl(self, name, thermostatState):
+        if name in self._pendingControls:
+            return self._pendingControls[name]
+        return self._inFlightControls.get(name, thermostatState[name])
+
+    # queue control changes to be sent to the thermostat in a single call when the coalesce window ends
+    # Note: must be called with the command lock held
+    def queueControls(self, **controls):
+
+        self._pendingControls.update(controls)
+
+        # start the coalesce window with the first queued change
+        if self._commandTimer is None:
+            self._commandTimer = threading.Timer(COMMAND_COALESCE_WINDOW, self.flushControls)
+            self._commandTimer.daemon = True
+            self._commandTimer.start()
+
+    # send the queued control changes to the thermostat and confirm the resulting state
+    def flushControls(self):
+
+        with self._commandLock:
+            controls = self._pendingControls
+            self._pendingControls = {}
+            if self._commandTimer is not None:
+                self._commandTimer.cancel()
+                self._commandTimer = None
+
+            # keep the changes available to the command handlers until the thermostat has them
+            self._inFlightControls = dict(self._inFlightControls, **controls)
+
+        if not controls:
+            return
+
+        LOGGER.debug("Sending queued control changes to thermostat %s: %s", self.name, str(controls))
+
+        # call the controls API to set all of the queued changes at once
+        success = self._conn.setThermostatControls(**controls)
+
+        # the changes are no longer in flight, unless they were queued again by a later flush
+        with self._commandLock:
+            for name in controls:
+                if self._inFlightControls.get(name) == controls[name]:
+                    del self._inFlightControls[name]
+
+        if success:
+            
+            self.commandCompleted()
+
+            # confirm the changes by updating the drivers from the state of the thermostat
+            self.updateNodeStates()
+
+        else:
+            LOGGER.error("Call to API setThermostatControls() failed for queued control changes: %s", str(controls))
+
+    # called after a command has changed the thermostat state
+    def commandCompleted(self):
+
+        # make sure the next poll is applied in full, since drivers were set from the command
+        self.controller.stateFeed.reset(self.address)
+
+        # poll the thermostat sooner to confirm the changes
+        self.controller.boostPolling(self.address)
+
+    # query the current state of this thermostat from the API
+    # Note: does not touch any drivers, so it is safe to call from a poll worker thread
+    def queryNodeStates(self):
+        return self._conn.getThermostatState()
+
+    # update the states for this thermostat, returning the state queried
+    # Note: the drivers are updated by the state feed subscription (see _stateChanged()) if any of the state fields changed
     def updateNodeStates(self, forceReport=False):
-        
-        # get the thermostat state from the API
-        thermoState = self._conn.getThermostatState() 
 
-        if thermoState:
+        # query the state and pass it to the state feed under the state lock, since this is called from the poll workers,
+        # the command timer, and the controller, and the feed must get the states of the thermostat in order
+        with self._stateLock:
+            thermoState = self.queryNodeStates()
+            dispatched = self.controller.stateFeed.update(self.address, thermoState, forceReport)
 
-            # set thermostat state to offline:
-            self.setDriver("GV0", 1, True, forceReport) # Thermostat online
+        # if the state is identical to the last state, count the driver updates skipped (only the online driver if offline)
+        if not dispatched:
+            self.suppressedUpdates += len(THERMOSTAT_STATE_DRIVERS) if thermoState else 1
+
+        # keep recording the unchanged state values in the history store, or stop recording the thermostat while it is offline
+        if self.controller.history is not None:
+            if thermoState:
+                self.controller.history.observe([history.getSeriesKey(self.address, field) for field in HISTORY_STATE_FIELDS])
+            else:
+                self.controller.history.forget(self.getHistorySeries())
+
+        return thermoState
+
+    # returns the series keys in the history store for the thermostat and its sensors
+    def getHistorySeries(self):
+
+        series = [history.getSeriesKey(self.address, field) for field in HISTORY_STATE_FIELDS]
+        for node in self.controller.getChildNodes(self.address):
+            series.extend(history.getSeriesKey(node.address, field) for field in HISTORY_SENSOR_FIELDS)
+        return series
+
+    # update the drivers from a change in the thermostat state (called by the state feed)
+    def _stateChanged(self, change):
+
+        thermoState = change.state
+        forceReport = change.full
+
+        if thermoState:
 
             # if the tempunits has changed, fix the node
-            if thermoState["tempunits"] != self.tempUnit:
-                self.changeTempUnits(thermoState["tempunits"])
+            if thermoState.tempunits != self.tempUnit:
+                self.changeTempUnits(thermoState.tempunits)
 
-            # udpate the remaining driver values
-            self.setDriver("ST", float(thermoState["spacetemp"]), True, forceReport)
-            self.setDriver("CLISPH", float(thermoState["heattemp"]), True, forceReport)
-            self.setDriver("CLISPC", float(thermoState["cooltemp"]), True, forceReport)
+            # Note: the API state properties are already converted to the driver types
+            values = {
+                "GV0": 1, # Thermostat online
+                "ST": thermoState.spacetemp,
+                "CLISPH": thermoState.heattemp,
+                "CLISPC": thermoState.cooltemp,
+            }
 
             # API thermostat mode utilizes values 0-3 (off, heat, cool, auto) and 13 (away) of ISY Thermostat mode UOM
-            if thermoState["away"] == 1:
-                self.setDriver("CLIMD", IX_TSTAT_MODE_AWAY, True, forceReport)
+            if thermoState.away == 1:
+                values["CLIMD"] = IX_TSTAT_MODE_AWAY
             else:
-                self.setDriver("CLIMD", int(thermoState["mode"]), True, forceReport)
+                values["CLIMD"] = thermoState.mode
 
             # API thermostat fan mode translates directly to first two values (0-1) of ISY Fan mode UOM
-            self.setDriver("CLIFS", int(thermoState["fan"]), True, forceReport)
+            values["CLIFS"] = thermoState.fan
 
             # API thermostat state translates directly to first three values (0-2) of ISY Thermostat heat/cool state UOM but has additional two values
-            if thermoState["state"] in (0, 1, 2): 
-                state = int(thermoState["state"])
+            if thermoState.state in (0, 1, 2): 
+                values["CLIHCS"] = thermoState.state
             else:
-                state = int(thermoState["state"]) + 10
-            self.setDriver("CLIHCS", state, True, forceReport) 
+                values["CLIHCS"] = thermoState.state + 10
 
             # API thermostat fan state mode translates directly to first two values (0-1) of ISY Fan running state UOM
-            self.setDriver("CLIFRS", int(thermoState["fanstate"]), True, forceReport)
+            values["CLIFRS"] = thermoState.fanstate
 
             # return humidity if present, otherwise zero
-            self.setDriver("CLIHUM", float(thermoState.get("hum", 0)), True, forceReport)
+            values["CLIHUM"] = thermoState.get("hum", 0.0)
 
             # translate API schedule part into ISY schedule mode indexed values, if present
-            self.setDriver("CLISMD", int(thermoState.get("schedulepart", IX_TSTAT_SCHED_MODE_INACTIVE)), True, forceReport)
+            values["CLISMD"] = thermoState.get("schedulepart", IX_TSTAT_SCHED_MODE_INACTIVE)
+
+            # report only the driver values that changed
+            for driver in values:
+                self.updateDriver(driver, values[driver], forceReport)
 
+            self.saveLastDrivers(values)
             
         else:
             # set thermostat state to offline:
-            self.setDriver("GV0", 0, True, force=forceReport) # Thermostat offline
+            self.updateDriver("GV0", 0, forceReport) # Thermostat offline
+            self.saveLastDrivers({"GV0": 0})
 
-    # update the sensor states and alerts for this thermostat
-    def updateSensorsandAlerts(self, forceReport=False):
-        
-        # get the alert properties for the thermostat
-        alertStates = self._conn.getThermostatAlerts() 
+    # update the sensor states, alerts, and runtimes for this thermostat
+    def updateSensorsandAlerts(self, forceReport=False, details=None):
 
-        if alertStates:
+        # get the alerts, sensor states, and runtimes from the API concurrently if they weren't already queried by longPoll
+        if details is None:
+            details = self._conn.getThermostatDetails()
+        alertStates, sensorStates, runtimes = details
 
-            # set the default alerts (filter, UV lamp, and service) from the alert info 
-            alerts = alertStates["alerts"]
-            self.setDriver("GV11", int(next((alert["active"] for alert in alerts if alert["name"] == "Air Filter"), False)), True, forceReport) 
-            self.setDriver("GV12", int(next((alert["active"] for alert in alerts if alert["name"] == "UV Lamp"), False)), True, forceReport) 
-            self.setDriver("GV13", int(next((alert["active"] for alert in alerts if alert["name"] == "Service"), False)), True, forceReport) 
-
-        # get the state of remote sensors connected to the thermostat
-        sensorStates = self._conn.getSensorStates() 
+        # skip the alerts if they are identical to the last alerts applied
+        if alertStates and not forceReport and alertStates == self._lastAlertStates:
+            self.suppressedUpdates += 3
 
-        if sensorStates:
-
-            # spin through the child nodes of this thermostat and update the sensors
-            for addr in self.controller.nodes:
-    
-                # if the device is a sensor node, retrieve the driver values from the sensor State data
-                node = self.controller.nodes[addr]
-                if node.id == "SENSOR" and node.primary == self.address:
+        elif alertStates:
 
-                    # locate the sensor in the sensor states corresponding to the node
-                    sensor = next((sensor for sensor in sensorStates["sensors"] if sensor["name"] == node.name), None)
-                    if sensor:
-                        node.setDriver("ST", float(sensor.get("temp", 0)), True, forceReport)
-                        node.setDriver("BATLVL", int(sensor.get("battery", 0)), True, forceReport)
+            # set the default alerts (filter, UV lamp, and service) from the alert info 
+            alerts = alertStates["alerts"]
+            values = {
+                "GV11": int(next((alert["active"] for alert in alerts if alert["name"] == "Air Filter"), False)),
+                "GV12": int(next((alert["active"] for alert in alerts if alert["name"] == "UV Lamp"), False)),
+                "GV13": int(next((alert["active"] for alert in alerts if alert["name"] == "Service"), False)),
+            }
+            for driver in values:
+                self.updateDriver(driver, values[driver], forceReport)
+            self._lastAlertStates = alertStates
+            self.saveLastDrivers(values)
+
+        # skip the sensors if they are identical to the last sensor states applied
+        if sensorStates and not forceReport and sensorStates == self._lastSensorStates:
+            for node in self.controller.getChildNodes(self.address):
+                if node.name in self._lastSensors:
+                    node.suppressedUpdates += 2
+
+                    # keep recording the unchanged sensor values in the history store
+                    if self.controller.history is not None:
+                        self.controller.history.observe([history.getSeriesKey(node.address, field) for field in HISTORY_SENSOR_FIELDS])
+
+        elif sensorStates:
+
+            # index the sensors in the sensor states by name
+            sensors = {sensor["name"]: sensor for sensor in sensorStates["sensors"]}
+
+            # spin through the sensor nodes of this thermostat and update the sensors
+            sensorDrivers = {}
+            for node in self.controller.getChildNodes(self.address):
+
+                # locate the sensor in the sensor states corresponding to the node
+                sensor = sensors.get(node.name)
+                if sensor:
+                    values = {"ST": float(sensor.get("temp", 0)), "BATLVL": int(sensor.get("battery", 0))}
+                    for driver in values:
+                        node.updateDriver(driver, values[driver], forceReport)
+                    sensorDrivers[node.name] = values
+
+                    # record the sensor values in the history store
+                    if self.controller.history is not None:
+                        self.controller.history.recordValues({history.getSeriesKey(node.address, field): sensor[field] for field in HISTORY_SENSOR_FIELDS if field in sensor})
+
+            self._lastSensorStates = sensorStates
+            self._lastSensors = sensors
+            with self.controller.customDataLock:
+                self._metadata["lastSensorDrivers"] = sensorDrivers
         
-        # get the runtimes for the thermostat
-        # TO-DO
+        # update the runtimes
+        if runtimes:
+            self.updateRuntimes(runtimes.get("runtimes", []), forceReport)
+
+    # merge new daily runtime records and update the runtime drivers from the current day
+    def updateRuntimes(self, records, forceReport=False):
+
+        # find the records that are new since the last update, starting from the newest
+        # Note: the record for the current day is updated by the thermostat throughout the day, so it is included again
+        newRecords = []
+        for record in reversed(records):
+            if record.get("ts", 0) < self._lastRuntimeTS:
+                break
+            newRecords.append(record)
+
+        # merge the new records, oldest first, replacing the current day record if it was updated
+        for record in reversed(newRecords):
+            if self._runtimes and self._runtimes[-1]["ts"] == record["ts"]:
+                self._runtimes[-1] = record
+            else:
+                self._runtimes.append(record)
+            self._lastRuntimeTS = record["ts"]
+
+        # report the runtimes (in minutes) of the HVAC stages for the current day
+        if self._runtimes:
+            today = self._runtimes[-1]
+            values = {driver: int(today.get(stage, 0)) for driver, stage in RUNTIME_DRIVERS}
+            for driver in values:
+                self.updateDriver(driver, values[driver], forceReport)
+            self.saveLastDrivers(values)
 
     # disconnect from the thermostat (close session) and show as offlien
     def disconnect(self):
 
+        # send any queued control changes
+        self.flushControls()
+
+        # stop updating the drivers from the state feed
+        self.controller.stateFeed.unsubscribe(self._stateSubscription)
+
         # close the session in the connection object
         self._conn.close()
 
         # set thermostat state to offline:
         self.setDriver("GV0", 0, True, True) # Thermostat offline
 
-    # override getDriver to return the last setDriver() value instead of reading from poly.config
-    def getDriver(self, dv):
-        return next((driver["value"] for driver in self.drivers if driver["driver"] == dv), None) 
-    
     drivers = [
         {"driver": "ST", "value": 0, "uom": ISY_TEMP_F_UOM},
         {"driver": "CLISPH", "value": 0, "uom": ISY_TEMP_F_UOM},
@@ -463,6 +828,13 @@ class Thermostat(polyinterface.Node):
         {"driver": "GV11", "value": 0, "uom": ISY_INDEX_UOM},
         {"driver": "GV12", "value": 0, "uom": ISY_INDEX_UOM},
         {"driver": "GV13", "value": 0, "uom": ISY_INDEX_UOM},
+        {"driver": "GV1", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV2", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV3", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV4", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV5", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV6", "value": 0, "uom": ISY_MINUTES_UOM},
+        {"driver": "GV7", "value": 0, "uom": ISY_MINUTES_UOM},
     ]
     commands = {
         "BRT": cmd_inc_dec,
@@ -481,10 +853,46 @@ class Controller(polyinterface.Controller):
     id = "CONTROLLER"
     _customData = {}
 
+    _pollExecutor = None
+    _pollSchedule = None
+    _pollScheduleLock = None
+    _pollStopEvent = None
+    _pollThread = None
+    _pollCount = 0
+    _pollFailureCount = 0
+    _registry = None
+    _resolver = None
+    _metricsServer = None
+    _childNodes = None
+    customDataLock = None
+    stateFeed = None
+    history = None
+    stateCacheTTL = DEFAULT_STATE_CACHE_TTL
+
     def __init__(self, poly):
         super(Controller, self).__init__(poly)
         self.name = "Venstar ColorTouch Nodeserver"
 
+        # worker pool for querying thermostats concurrently
+        self._pollExecutor = ThreadPoolExecutor(max_workers=MAX_POLL_WORKERS)
+
+        # sensor nodes for each thermostat, keyed by thermostat address and then sensor address
+        self._childNodes = {}
+
+        # lock for changes to the custom data (including the thermostat metadata) from the poll worker threads
+        self.customDataLock = threading.Lock()
+
+        # feed of the changes in the thermostat states from the poll scheduler, keyed by node address
+        self.stateFeed = api.stateFeed(LOGGER)
+
+        # resolver for the hostnames specified in the custom configuration parameters
+        self._resolver = api.hostResolver(self._hostResolved, logger=LOGGER)
+
+        # poll schedule for each thermostat, keyed by node address
+        self._pollSchedule = {}
+        self._pollScheduleLock = threading.Lock()
+        self._pollStopEvent = threading.Event()
+
     # Start the node server
     def start(self):
 
@@ -498,6 +906,19 @@ class Controller(polyinterface.Controller):
         if level is not None:
             LOGGER.setLevel(int(level))
 
+        # get the freshness window for cached thermostat states from the custom configuration parameters
+        customParams = self.polyConfig["customParams"]
+        self.stateCacheTTL = self.getNumericParam(PARAM_STATE_CACHE_TTL, DEFAULT_STATE_CACHE_TTL)
+
+        # configure the HTTP connection pool shared by all of the thermostats before any API calls
+        api.configureConnectionPool(
+            poolSize=self.getNumericParam(PARAM_POOL_SIZE, None, int),
+            poolSizePerHost=self.getNumericParam(PARAM_POOL_SIZE_PER_HOST, None, int),
+            keepAliveTimeout=self.getNumericParam(PARAM_KEEPALIVE_TIMEOUT, None),
+            connectTimeout=self.getNumericParam(PARAM_CONNECT_TIMEOUT, None),
+            readTimeout=self.getNumericParam(PARAM_READ_TIMEOUT, None)
+        )
+
         # load nodes previously saved to the polyglot database
         # Note: has to be done in two passes to ensure thermostat (primary/parent) nodes exist
         # before sensor (child) nodes
@@ -520,17 +941,62 @@ class Controller(polyinterface.Controller):
                 if node["node_def_id"] == "SENSOR":
                     self.addNode(Sensor(self, node["primary"], addr, node["name"], self.nodes[node["primary"]].tempUnit))
 
+        # report the last known driver values of the thermostats and sensors until they are polled
+        for node in self.getThermostatNodes():
+            node.reportLastDrivers()
+
         # Set the nodeserver status flag to indicate nodeserver is running
         self.setDriver("ST", 1, True, True)
 
         # Report the logger level to the ISY
         self.setDriver("GV20", LOGGER.level, True, True)
 
+        # start the adaptive poll scheduler for the thermostat states
+        self.startPollScheduler()
+
+        # if a metrics port is specified, serve the API call metrics for Prometheus
+        if PARAM_METRICS_PORT in customParams:
+            try:
+                self._metricsServer = api.startMetricsServer(int(customParams[PARAM_METRICS_PORT]))
+            except (ValueError, OSError) as e:
+                LOGGER.warning("Unable to start metrics server on port %s: %s", customParams[PARAM_METRICS_PORT], str(e))
+
+        # start the local history store for the thermostat states, unless disabled
+        historyDays = self.getNumericParam(PARAM_HISTORY_DAYS, DEFAULT_HISTORY_DAYS, int)
+        if historyDays > 0:
+            try:
+                self.history = history.historyStore(HISTORY_DIR, historyDays, HISTORY_HOURLY_DAYS, logger=LOGGER)
+                self.history.start()
+
+                # record the changes in the thermostat states
+                self.stateFeed.subscribe(self._recordStateChange, HISTORY_STATE_FIELDS)
+            except OSError as e:
+                LOGGER.warning("Unable to open history store in %s: %s", HISTORY_DIR, str(e))
+
+        # if thermostats are discovered dynamically, listen for SSDP announcements to track changes in their IP addresses
+        if PARAM_HOSTNAMES not in customParams:
+            self._registry = api.thermostatRegistry(self._thermostatAnnounced, LOGGER)
+            self._registry.start(self._getInterfaces())
+
+        # otherwise resolve the specified hostnames in the background to track changes in their IP addresses
+        else:
+            self._resolver.start(customParams[PARAM_HOSTNAMES].split(";"))
+
     # shutdown the nodeserver on stop
     def stop(self):
 
+        # stop the poll scheduler, the SSDP listener, and the hostname resolver
+        self._pollStopEvent.set()
+        if self._registry is not None:
+            self._registry.stop()
+        self._resolver.stop()
+
+        # stop the metrics server
+        if self._metricsServer is not None:
+            self._metricsServer.shutdown()
+
         # iterate through the nodes of the nodeserver and disconnect thermostats
-        for addr in self.nodes:      
+        for addr in list(self.nodes):      
             # ignore the controller node
             if addr != self.address:
                 # if the device is a thermostat node, call the disconnect method
@@ -538,6 +1004,14 @@ class Controller(polyinterface.Controller):
                 if node.id in ("THERMOSTAT", "THERMOSTAT_C"):
                     node.disconnect()
 
+        # shutdown the poll worker pool and close the API's shared HTTP session
+        self._pollExecutor.shutdown(wait=False)
+        api.shutdown()
+
+        # write any pending state history to disk
+        if self.history is not None:
+            self.history.stop()
+
         # Set the nodeserver status flag to indicate nodeserver is not running
         self.setDriver("ST", 0, True, True)
     
@@ -568,53 +1042,211 @@ class Controller(polyinterface.Controller):
 
         # store the new loger level in custom data
         self.addCustomData("loggerlevel", value)
-        self.saveCustomData(self._customData)
+        self.saveCustomDataSnapshot()
 
         # report new value to ISY
         self.setDriver("GV20", value)
 
+    # Set the mode or a setpoint of all thermostats at once
+    def cmd_set_all(self, command):
+
+        LOGGER.info("Set all thermostats in cmd_set_all(): %s", str(command))
+
+        cmd = command["cmd"]
+
+        # skip thermostats that are not responding to polls to keep from waiting on timeouts
+        nodes = [node for node in self.getThermostatNodes() if not self.isPollBackingOff(node.address)]
+
+        # build the change for the command for each thermostat
+        if cmd == "SET_CLIMD_ALL":
+            mode = int(command.get("value"))
+            change = {"away": 1} if mode == IX_TSTAT_MODE_AWAY else {"away": 0, "mode": mode}
+            changes = [change for node in nodes]
+
+        # setpoints are specified in farenheit (or celcius if the command has the celcius UOM) and converted to the temperature unit of each thermostat
+        else:
+            setpoint = float(command.get("value"))
+            tempUnit = 1 if int(command.get("uom", ISY_TEMP_F_UOM)) == ISY_TEMP_C_UOM else 0
+            key = "heattemp" if cmd == "SET_CLISPH_ALL" else "cooltemp"
+            changes = [{key: convertTemp(setpoint, tempUnit, node.tempUnit)} for node in nodes]
+
+        # send any changes queued for the thermostats first so they don't override the group change
+        for node in nodes:
+            node.flushControls()
+
+        # apply the change to all of the thermostats concurrently
+        results = api.setMultipleThermostats([(node.getConnection(), change) for node, change in zip(nodes, changes)], maxAge=self.stateCacheTTL, logger=LOGGER)
+        changedNodes = [node for node, result in zip(nodes, results) if result["success"]]
+        LOGGER.info("%s applied to %i of %i thermostat(s).", cmd, len(changedNodes), len(nodes))
+
+        # confirm the changes by updating the drivers from the states of the changed thermostats concurrently in the worker pool
+        for node in changedNodes:
+            node.commandCompleted()
+        for future in [self._pollExecutor.submit(node.updateNodeStates) for node in changedNodes]:
+            future.result()
+
     # called every longPoll seconds (default 30)
     def longPoll(self):
 
         LOGGER.info("Updating alerts and runtimes in longPoll()...")                     
         
-        # iterate through the nodes of the nodeserver
-        for addr in self.nodes:
-        
-            # ignore the controller node
-            if addr != self.address:
-
-                # if the device is a thermostat node, call the sensors and alerts method
-                node = self.controller.nodes[addr]
-                if node.id in ("THERMOSTAT", "THERMOSTAT_C"):
-                    node.updateSensorsandAlerts()
+        # query the alerts, sensor states, and runtimes of all the thermostats concurrently
+        # Note: skip thermostats that are not responding to polls to keep from waiting on timeouts
+        nodes = [node for node in self.getThermostatNodes() if not self.isPollBackingOff(node.address)]
+        allDetails = api.getMultipleThermostatDetails([node.getConnection() for node in nodes])
+
+        # update the drivers of each thermostat from its results
+        for node, details in zip(nodes, allDetails):
+            try:
+                node.updateSensorsandAlerts(details=details)
+            except:
+                LOGGER.exception("Unexpected error updating sensors and alerts for thermostat %s.", node.name)
 
         # saved any instance variable changes to Polyglot (e.g., temp units)
-        self.saveCustomData(self._customData)
+        self.saveCustomDataSnapshot()
+
+        # log the reuse of the HTTP connections to the thermostats
+        connections = api.metrics.getConnectionSummary()
+        LOGGER.info("%i HTTP connection(s) opened and %i reused since the nodeserver started.", connections["opened"], connections["reused"])
+
+        # log the thermostats with the slowest API responses
+        hostSummary = api.metrics.getHostSummary()
+        for host in sorted(hostSummary, key=lambda host: hostSummary[host]["meanLatency"] or 0.0, reverse=True)[:3]:
+            summary = hostSummary[host]
+            LOGGER.info("Thermostat at %s: %i API call(s), %i error(s), mean latency %.3f seconds.", host, summary["calls"], summary["errors"], summary["meanLatency"] or 0.0)
 
     # called every shortPoll seconds
+    # Note: thermostat states are polled by the adaptive poll scheduler, so just check on the scheduler here
     def shortPoll(self):
 
-        LOGGER.info("Updating node states in shortPoll()...")
-        
-        # iterate through the nodes of the nodeserver
-        for addr in self.nodes:
-        
-            # ignore the controller node
-            if addr != self.address:
+        # restart the poll scheduler if the thread has died
+        if self._pollThread is None or not self._pollThread.is_alive():
+            LOGGER.warning("Poll scheduler not running - restarting in shortPoll()...")
+            self.startPollScheduler()
 
-                # if the device is a thermostat node, call the update node states method
-                node = self.controller.nodes[addr]
-                if node.id in ("THERMOSTAT", "THERMOSTAT_C"):
-                    node.updateNodeStates()          
+        LOGGER.info("Poll scheduler completed %i thermostat poll(s) with %i failure(s) since last shortPoll.", self._pollCount, self._pollFailureCount)
+        LOGGER.info("%i redundant driver update(s) suppressed since the nodeserver started.", self.getSuppressedUpdates())
+        self._pollCount = 0
+        self._pollFailureCount = 0
+
+    # start the thread for the adaptive poll scheduler
+    def startPollScheduler(self):
+
+        self._pollStopEvent.clear()
+        self._pollThread = threading.Thread(target=self._runPollScheduler, name="pollScheduler", daemon=True)
+        self._pollThread.start()
+
+    # adaptive poll scheduler loop - submits each thermostat to the worker pool when it is due to be polled
+    def _runPollScheduler(self):
+
+        while not self._pollStopEvent.wait(POLL_SCHEDULER_TICK):
+            
+            now = time.time()
+            for node in self.getThermostatNodes():
+
+                # new thermostats are due immediately
+                with self._pollScheduleLock:
+                    schedule = self._getPollSchedule(node.address)
+                    if schedule["busy"] or schedule["due"] > now:
+                        continue
+                    schedule["busy"] = True
+                
+                self._pollExecutor.submit(self._pollThermostat, node)
+
+    # poll the state of the thermostat and schedule the next poll (runs in the worker pool)
+    def _pollThermostat(self, node):
+
+        thermoState = False
+        try:
+            thermoState = node.updateNodeStates()
+        except:
+            LOGGER.exception("Unexpected error polling state for thermostat %s.", node.name)
+        finally:
+            self._scheduleNextPoll(node.address, thermoState)
+
+    # determine the next poll time for the thermostat from its state
+    def _scheduleNextPoll(self, addr, thermoState):
+
+        shortPoll = float(self.polyConfig.get("shortPoll", 10))
+        now = time.time()
+
+        with self._pollScheduleLock:
+
+            schedule = self._getPollSchedule(addr)
+            self._pollCount += 1
+
+            # exponential backoff for thermostats that are not responding
+            if not thermoState:
+                self._pollFailureCount += 1
+                schedule["failures"] += 1
+                interval = min(shortPoll * 2 ** schedule["failures"], POLL_BACKOFF_MAX)
+
+            else:
+                schedule["failures"] = 0
+                
+                # poll fastest right after a command, faster while HVAC or fan is running, and slowest while idle
+                if now < schedule["boost"]:
+                    interval = POLL_INTERVAL_COMMAND
+                elif thermoState.state in (1, 2) or thermoState.fanstate == 1:
+                    interval = shortPoll * POLL_ACTIVE_FACTOR
+                else:
+                    interval = shortPoll * POLL_IDLE_FACTOR
+
+            # add jitter to spread the polls out over time
+            schedule["due"] = now + interval * random.uniform(1.0 - POLL_JITTER, 1.0 + POLL_JITTER)
+            schedule["busy"] = False
+
+    # returns the poll schedule for the thermostat, adding it as due now if new
+    # Note: must be called with the poll schedule lock held
+    def _getPollSchedule(self, addr):
+        return self._pollSchedule.setdefault(addr, {"due": 0.0, "failures": 0, "boost": 0.0, "busy": False})
+
+    # poll the thermostat at the command interval for a while (e.g., after a command was sent)
+    def boostPolling(self, addr):
+
+        now = time.time()
+        with self._pollScheduleLock:
+            schedule = self._getPollSchedule(addr)
+            schedule["boost"] = now + POLL_COMMAND_BOOST_TIME
+            schedule["due"] = min(schedule["due"], now + POLL_INTERVAL_COMMAND)
+
+    # returns True if the thermostat is currently failing polls (and being backed off)
+    def isPollBackingOff(self, addr):
+
+        with self._pollScheduleLock:
+            schedule = self._pollSchedule.get(addr)
+            return schedule is not None and schedule["failures"] > 0
+
+    # returns the total number of redundant driver updates suppressed by the thermostat and sensor nodes
+    def getSuppressedUpdates(self):
+        return sum(node.suppressedUpdates for node in list(self.nodes.values()) if isinstance(node, VenstarNode))
+
+    # override addNode to maintain the index of sensor nodes for each thermostat
+    def addNode(self, node, update=False):
+
+        result = super(Controller, self).addNode(node, update)
+        if result and node.id == "SENSOR":
+            self._childNodes.setdefault(node.primary, {})[node.address] = node
+
+        return result
+
+    # returns a list of the sensor nodes of a thermostat
+    def getChildNodes(self, addr):
+        return list(self._childNodes.get(addr, {}).values())
+
+    # returns a list of the thermostat nodes of the nodeserver
+    # Note: iterates a copy of the nodes, since nodes are added by discovery and the SSDP listener while the poll threads call this
+    def getThermostatNodes(self):
+        return [node for node in list(self.nodes.values()) if node.id in ("THERMOSTAT", "THERMOSTAT_C")]
 
     # discover thermostats and SBB devices
     def discover(self):
 
         self.removeNoticesAll()
 
-        # create an empty array for the thermostat list
+        # create empty arrays for the thermostat list and the API queries for each thermostat
         thermostats = []
+        probes = []
     
         # Check to see if one or more hostnames were specified in the in custom custom configuration parameters
         customParams = self.polyConfig["customParams"]
@@ -622,39 +1254,60 @@ class Controller(polyinterface.Controller):
             
             dynamicDiscovery = False
 
-            # iterate through hostnames in custom configuration and build an array of thermostats
+            # resolve the hostnames in custom configuration concurrently (recently resolved hostnames are cached)
             hosts = customParams[PARAM_HOSTNAMES].split(";")
+            addresses = self._resolver.resolve(hosts)
+
+            # iterate through hostnames and build an array of thermostats
             for host in hosts:
 
-                # since we don't have an ID or mac address, build one with the last 4 
-                try:
-                    id = str(hex(int(IPv4Address(socket.gethostbyname(host)))))[-8:]
-                except:                    
+                address = addresses.get(host)
+                if address is None:
                     # add notice that host was resolved
                     LOGGER.warning("Unable to resolve address for specified hostname %s", host)
                     self.addNotice("Unable to resolve address for specified hostname {}. Please check the 'hostname' parameter value in the Custom Configuration Parameters and restart the nodeserver before retrying.".format(host))
                     continue               
+
+                # use the node already setup for the hostname, so a changed address doesn't add another node
+                node = next((node for node in self.getThermostatNodes() if node.getHostName() == host), None)
+                if node is not None:
+                    id = node.address
+
+                # since we don't have an ID or mac address, build one from the IP address (and port, if specified)
+                else:
+                    id = getAddressID(address)
                 
-                # if the id was resolved, add it to the therostat list
+                # add it to the therostat list and start querying the info from the API at the resolved address
                 thermostats.append({
                     "id": id,
                     "hostname": host,
+                    "address": address,
                 })                    
+                probes.append(api.probeThermostat(address, LOGGER))
 
         else:
 
             dynamicDiscovery = True
 
-            # Discover thermostats using SSDP
-            thermostats.extend(api.discoverThermostats(10, LOGGER))
+            # Discover thermostats using SSDP, starting to query the info from the API for each as it responds
+            for thermostat in self._iterDiscoveredThermostats():
+
+                # skip querying thermostats that are setup and have not changed since they were last discovered
+                node = self.nodes.get(getValidNodeAddress(thermostat["id"][-8:]))
+                if node is not None and node.isDiscoveryUnchanged(thermostat.get("usn"), thermostat.get("location")):
+                    LOGGER.info("Thermostat at hostname %s unchanged since last discovery.", thermostat["hostname"])
+                    continue
+
+                thermostats.append(thermostat)
+                probes.append(api.probeThermostat(thermostat["hostname"], LOGGER))
 
         # Process each discovered or specified thermostat
-        for thermostat in thermostats:
+        for thermostat, probe in zip(thermostats, probes):
 
             hostName = thermostat["hostname"]
 
             # get the relevant info for the thermostat from the API
-            thermoInfo = api.getThermostatInfo(hostName, LOGGER)
+            thermoInfo = probe.result()
             
             if thermoInfo:
 
@@ -667,7 +1320,7 @@ class Controller(polyinterface.Controller):
                 if thermoInfo["type"] != api.THERMO_TYPE_RESIDENTIAL:
               
                     # Add a notice to Polyglot dashboard
-                    self.addNotice("Thermostat of type {} at hostname {} not supported. Currently only residential thermostats supported.".format(thermoType, hostName))
+                    self.addNotice("Thermostat of type {} at hostname {} not supported. Currently only residential thermostats supported.".format(thermoInfo["type"], hostName))
                     continue
 
                 else:
@@ -688,6 +1341,17 @@ class Controller(polyinterface.Controller):
                     else:
                         thermostatNode = self.nodes[thermostatAddr]
 
+                        # update the hostname if the thermostat has a new IP address
+                        if thermostatNode.getHostName() != hostName:
+                            thermostatNode.setHostName(hostName)
+
+                    # use the resolved IP address for a specified hostname
+                    if "address" in thermostat:
+                        thermostatNode.setConnectionAddress(thermostat["address"])
+
+                    # save the thermostat info and SSDP announcement to the thermostat metadata
+                    thermostatNode.saveDiscoveryInfo(thermoInfo, thermostat.get("usn"), thermostat.get("location"))
+
                     # add child nodes for the thermostats sensors
                     n = 0
                     for sensor in thermoInfo["sensors"]:
@@ -707,25 +1371,99 @@ class Controller(polyinterface.Controller):
                     self.addNotice("Unable to connect to thermostat at hostname {}. Please check the 'hostname' parameter value in the Custom Configuration Parameters and/or that the thermostat is reachable on your network from your Polyglot server before retrying.".format(hostName))
 
         # send custom data added by new nodes to polyglot
-        self.saveCustomData(self._customData)
+        self.saveCustomDataSnapshot()
+
+        # update all driver values for all the discovered thermostats and devices concurrently in the worker pool
+        for future in [self._pollExecutor.submit(self._updateAllStates, node) for node in self.getThermostatNodes()]:
+            future.result()
 
-        # update all driver values for all the discovered thermostats and devices
-        for addr in self.nodes:
+    # update all driver values for the thermostat, forcing the values to be reported (runs in the worker pool)
+    def _updateAllStates(self, node):
         
-            # ignore the controller node
-            if addr != self.address:
+        try:
+            node.updateNodeStates(True)
+            node.updateSensorsandAlerts(True)
+        except:
+            LOGGER.exception("Unexpected error updating states for thermostat %s.", node.name)
+
+    # discover thermostats using SSDP, followed by the thermostats in the registry that did not respond to the search
+    def _iterDiscoveredThermostats(self):
+
+        found = set()
+        for thermostat in api.iterDiscoverThermostats(10, LOGGER, self._getInterfaces()):
+            found.add(thermostat["id"])
+
+            # refresh the thermostat in the registry of announced thermostats
+            if self._registry is not None:
+                self._registry.update(thermostat, thermostat.get("maxage"))
+
+            yield thermostat
+
+        # thermostats with unexpired announcements may have missed the search (e.g., a lost UDP response)
+        if self._registry is not None:
+            for thermostat in self._registry.getThermostats():
+                if thermostat["id"] not in found:
+                    LOGGER.info("Thermostat %s not found in discovery, using its last announcement.", thermostat["name"])
+                    yield thermostat
+
+    # called by the thermostat registry when a thermostat is first announced or announces a new hostname
+    def _thermostatAnnounced(self, thermostat):
+
+        node = self.nodes.get(getValidNodeAddress(thermostat["id"][-8:]))
+        if node is None:
+            LOGGER.info("Thermostat %s announced at hostname %s is not setup - run Discover Thermostats to add it.", thermostat["name"], thermostat["hostname"])
+        
+        # if the IP address of an existing thermostat changed, update the node
+        elif node.getHostName() != thermostat["hostname"]:
+            LOGGER.info("Hostname for thermostat %s changed from %s to %s.", node.name, node.getHostName(), thermostat["hostname"])
+            node.setHostName(thermostat["hostname"])
+            self.saveCustomDataSnapshot()
 
-                # if the device is a thermostat node, call the updateNodeStates method
-                node = self.controller.nodes[addr]
-                if node.id in ("THERMOSTAT", "THERMOSTAT_C"):
-                    node.updateNodeStates(True)
-                    node.updateSensorsandAlerts(True)
+    # record a change in a thermostat state in the history store (called by the state feed)
+    def _recordStateChange(self, change):
+        self.history.recordValues({history.getSeriesKey(change.key, field): change.changes[field] for field in change.changes if change.changes[field] is not None}, change.timestamp)
+
+    # called by the hostname resolver when a specified hostname is first resolved or resolves to a new IP address
+    def _hostResolved(self, host, address):
+
+        for node in self.getThermostatNodes():
+            if node.getHostName() == host:
+                node.setConnectionAddress(address)
+
+    # returns the numeric value of a custom configuration parameter, or the default if not specified or invalid
+    def getNumericParam(self, key, default, convert=float):
+
+        customParams = self.polyConfig["customParams"]
+        if key in customParams:
+            try:
+                return convert(customParams[key])
+            except ValueError:
+                LOGGER.warning("Invalid value for %s parameter: %s", key, customParams[key])
+
+        return default
+
+    # returns the list of local interfaces to use for SSDP from the custom configuration parameters (None for default)
+    def _getInterfaces(self):
+
+        customParams = self.polyConfig["customParams"]
+        if PARAM_INTERFACES in customParams:
+            return customParams[PARAM_INTERFACES].split(";")
+        else:
+            return None
 
     # helper method for storing custom data
     def addCustomData(self, key, data):
 
         # add specififed data to custom data for specified key
-        self._customData.update({key: data})
+        with self.customDataLock:
+            self._customData.update({key: data})
+
+    # send a copy of the custom data to Polyglot, so it isn't changed by the poll worker threads while it is being sent
+    def saveCustomDataSnapshot(self):
+
+        with self.customDataLock:
+            customData = copy.deepcopy(self._customData)
+        self.saveCustomData(customData)
 
     # helper method for retrieve custom data
     def getCustomData(self, key):
@@ -743,9 +1481,48 @@ class Controller(polyinterface.Controller):
     commands = {
         "DISCOVER": cmd_discover,
         "UPDATE_PROFILE" : cmd_updateProfile,
-        "SET_LOGLEVEL": cmd_setLogLevel
+        "SET_LOGLEVEL": cmd_setLogLevel,
+        "SET_CLIMD_ALL": cmd_set_all,
+        "SET_CLISPH_ALL": cmd_set_all,
+        "SET_CLISPC_ALL": cmd_set_all,
     }
 
+# returns the thermostat metadata from polyglot custom data, converting the legacy "hostname;type;tempunit" string
+def parseMetadata(cData):
+
+    if isinstance(cData, str):
+        hostName, type, tempUnit = cData.split(";")[:3]
+        return {
+            "version": METADATA_VERSION,
+            "hostName": hostName,
+            "type": type,
+            "tempUnit": int(tempUnit),
+        }
+
+    return dict(cData)
+
+# builds an ID for a thermostat from the last 4 bytes of its IP address, or the last 2 bytes and the port if a port is specified
+def getAddressID(address):
+
+    # import the module for parsing IP addresses only when it is needed
+    from ipaddress import IPv4Address
+
+    host, sep, port = address.partition(":")
+    if port:
+        return "{:08x}".format(int(IPv4Address(host)))[-4:] + "{:04x}".format(int(port))
+    else:
+        return str(hex(int(IPv4Address(host))))[-8:]
+
+# converts a temperature between temp units (0-F or 1-C), rounding to the setpoint precision of the thermostats (1 degree F or 0.5 degree C)
+def convertTemp(temp, fromUnit, toUnit):
+
+    if fromUnit == toUnit:
+        return temp
+    elif toUnit == 1:
+        return round((temp - 32.0) * 5.0 / 9.0 * 2.0) / 2.0
+    else:
+        return float(round(temp * 9.0 / 5.0 + 32.0))
+
 # Removes invalid charaters and lowercase ISY Node address
 def getValidNodeAddress(s):
 
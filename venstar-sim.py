@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+"""
+Simulator for Venstar ColorTouch thermostats (local REST API v5 and SSDP discovery)
+for load and regression testing of venstarapi and the nodeserver without hardware
+
+Each virtual thermostat listens on its own port (base port + n) of the specified address
+and answers SSDP M-SEARCH requests for "colortouch:ecp" like the real thermostats.
+"""
+
+import sys
+import time
+import random
+import socket
+import asyncio
+import threading
+import logging
+import argparse
+import resource
+from urllib.parse import quote
+from aiohttp import web
+
+_LOGGER = logging.getLogger("venstar-sim")
+
+_SSDP_GROUP = ("239.255.255.250", 1900)
+_SSDP_SEARCH_TARGET = "colortouch:ecp"
+_SSDP_MAX_AGE = 300
+
+# rate (degrees per second) the space temperature moves when the HVAC is running or idle
+_TEMP_RATE_RUNNING = 0.02
+_TEMP_RATE_IDLE = 0.005
+_TEMP_DRIFT_TARGET = 80.0
+
+# constants for mode and state
+THERMO_MODE_OFF = 0
+THERMO_MODE_HEAT = 1
+THERMO_MODE_COOL = 2
+THERMO_MODE_AUTO = 3
+THERMO_STATE_IDLE = 0
+THERMO_STATE_HEATING = 1
+THERMO_STATE_COOLING = 2
+
+# virtual thermostat with the state and behavior of a residential ColorTouch
+class virtualThermostat(object):
+
+    def __init__(self, index, port, offline=False):
+
+        self.index = index
+        self.port = port
+        self.offline = offline
+        self.mac = "00:23:a7:{:02x}:{:02x}:{:02x}".format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        self.name = "Thermostat {}".format(index + 1)
+        self.lastUpdate = time.time()
+        self.requestTimes = []
+
+        self.state = {
+            "name": self.name,
+            "mode": random.choice((THERMO_MODE_HEAT, THERMO_MODE_COOL, THERMO_MODE_AUTO)),
+            "state": THERMO_STATE_IDLE,
+            "activestage": 0,
+            "fan": 0,
+            "fanstate": 0,
+            "tempunits": 0,
+            "schedule": 0,
+            "schedulepart": 255,
+            "away": 0,
+            "spacetemp": round(random.uniform(66.0, 78.0)),
+            "heattemp": 68,
+            "cooltemp": 75,
+            "cooltempmin": 35,
+            "cooltempmax": 99,
+            "heattempmin": 35,
+            "heattempmax": 99,
+            "setpointdelta": 2,
+            "hum": random.randint(30, 55),
+            "hum_setpoint": 0,
+            "dehum_setpoint": 99,
+            "availablemodes": 0,
+        }
+        self.sensors = [
+            {"name": "Thermostat", "temp": self.state["spacetemp"]},
+            {"name": "Remote", "temp": self.state["spacetemp"] - 1, "battery": random.randint(20, 100)},
+            {"name": "Space Temp", "temp": self.state["spacetemp"]},
+        ]
+        self.alerts = [
+            {"name": "Air Filter", "active": random.random() < 0.1},
+            {"name": "UV Lamp", "active": False},
+            {"name": "Service", "active": False},
+        ]
+
+        # runtime records (minutes) for the last 7 days, the last one being today
+        today = int(time.time()) // 86400 * 86400
+        self.runtimes = [{
+            "ts": today - 86400 * day,
+            "heat1": random.randint(0, 300),
+            "heat2": 0,
+            "cool1": random.randint(0, 300),
+            "cool2": 0,
+            "aux1": 0,
+            "aux2": 0,
+            "fc": 0,
+        } for day in range(6, -1, -1)]
+        self.runtimes[-1].update({"heat1": 0, "cool1": 0})
+
+        # seconds each stage has run that are not yet counted in the (whole minute) runtimes
+        self.runSeconds = {"heat1": 0.0, "cool1": 0.0}
+
+    # USN for the thermostat as sent in SSDP responses
+    def getUSN(self):
+        return "ecp:{}:name:{}:type:residential".format(self.mac, quote(self.name))
+
+    # move the simulated space temperature, HVAC state, and runtimes forward to the current time
+    def update(self):
+
+        now = time.time()
+        elapsed = now - self.lastUpdate
+        self.lastUpdate = now
+        state = self.state
+
+        # run the HVAC based on the mode and setpoints (with a half degree of hysteresis)
+        mode = THERMO_MODE_OFF if state["away"] else state["mode"]
+        temp = state["spacetemp"]
+        if mode in (THERMO_MODE_HEAT, THERMO_MODE_AUTO) and temp < state["heattemp"] - 0.5:
+            state["state"] = THERMO_STATE_HEATING
+        elif mode in (THERMO_MODE_COOL, THERMO_MODE_AUTO) and temp > state["cooltemp"] + 0.5:
+            state["state"] = THERMO_STATE_COOLING
+        elif (state["state"] == THERMO_STATE_HEATING and temp >= state["heattemp"]) or (state["state"] == THERMO_STATE_COOLING and temp <= state["cooltemp"]) or mode == THERMO_MODE_OFF:
+            state["state"] = THERMO_STATE_IDLE
+        state["fanstate"] = 1 if state["state"] != THERMO_STATE_IDLE or state["fan"] == 1 else 0
+        state["activestage"] = 1 if state["state"] != THERMO_STATE_IDLE else 0
+
+        # move the space temperature
+        if state["state"] == THERMO_STATE_HEATING:
+            temp += _TEMP_RATE_RUNNING * elapsed
+            self.addRuntime("heat1", elapsed)
+        elif state["state"] == THERMO_STATE_COOLING:
+            temp -= _TEMP_RATE_RUNNING * elapsed
+            self.addRuntime("cool1", elapsed)
+        else:
+            temp += max(min(_TEMP_DRIFT_TARGET - temp, _TEMP_RATE_IDLE * elapsed), -_TEMP_RATE_IDLE * elapsed)
+        state["spacetemp"] = round(temp, 1) if state["tempunits"] == 1 else round(temp)
+
+        self.sensors[0]["temp"] = state["spacetemp"]
+        self.sensors[2]["temp"] = state["spacetemp"]
+
+    # add the seconds a stage ran to today's runtime, moving whole minutes into the runtime record
+    def addRuntime(self, stage, seconds):
+
+        self.runSeconds[stage] += seconds
+        minutes = int(self.runSeconds[stage] // 60)
+        self.runSeconds[stage] -= minutes * 60
+        self.runtimes[-1][stage] += minutes
+
+    # apply the parameters from a control request, returning the response data
+    def setControls(self, params):
+
+        state = self.state
+        try:
+            mode = int(params.get("mode", state["mode"]))
+            fan = int(params.get("fan", state["fan"]))
+            heattemp = float(params.get("heattemp", state["heattemp"]))
+            cooltemp = float(params.get("cooltemp", state["cooltemp"]))
+        except ValueError:
+            return {"error": True, "reason": "Invalid parameter value"}
+
+        if state["away"] and ("heattemp" in params or "cooltemp" in params or "fan" in params):
+            return {"error": True, "reason": "Cannot change setpoints or fan in away mode"}
+        if mode not in (0, 1, 2, 3) or fan not in (0, 1):
+            return {"error": True, "reason": "Invalid mode or fan value"}
+        if ("mode" in params or "heattemp" in params or "cooltemp" in params) and not ("heattemp" in params and "cooltemp" in params):
+            return {"error": True, "reason": "heattemp and cooltemp must both be specified"}
+        if not (state["heattempmin"] <= heattemp <= state["heattempmax"]) or not (state["cooltempmin"] <= cooltemp <= state["cooltempmax"]):
+            return {"error": True, "reason": "Setpoint out of range"}
+        if mode == THERMO_MODE_AUTO and cooltemp - heattemp < state["setpointdelta"]:
+            return {"error": True, "reason": "Setpoints must be at least setpointdelta apart in auto mode"}
+
+        state.update({"mode": mode, "fan": fan, "heattemp": heattemp, "cooltemp": cooltemp})
+        return {"success": True}
+
+    # apply the parameters from a settings request, returning the response data
+    def setSettings(self, params):
+
+        state = self.state
+        limits = {"tempunits": (0, 1), "away": (0, 1), "schedule": (0, 1), "hum_setpoint": (0, 60), "dehum_setpoint": (25, 99)}
+        try:
+            settings = {setting: int(params[setting]) for setting in params if setting in limits}
+        except ValueError:
+            return {"error": True, "reason": "Invalid parameter value"}
+
+        for setting in settings:
+            if not limits[setting][0] <= settings[setting] <= limits[setting][1]:
+                return {"error": True, "reason": "Invalid value for {}".format(setting)}
+
+        state.update(settings)
+        if "schedule" in settings:
+            state["schedulepart"] = 1 if settings["schedule"] else 255
+        return {"success": True}
+
+# simulator serving the REST API and SSDP for a set of virtual thermostats
+class thermostatSimulator(object):
+
+    def __init__(self, count=1, address="127.0.0.1", basePort=8000, latency=0.0, jitter=0.0, errorRate=0.0,
+                 timeoutRate=0.0, rateLimit=0, offlineRate=0.0, ssdp=True, notifyInterval=0):
+        """Creates the simulator
+
+        Parameters:
+        count -- number of virtual thermostats
+        address -- local IP address to listen on and advertise in SSDP
+        basePort -- port of the first thermostat, the others use the following ports
+        latency -- mean delay (in seconds) added to each response
+        jitter -- maximum random variation (in seconds) of the delay
+        errorRate -- fraction of requests that return an HTTP 500 error
+        timeoutRate -- fraction of requests that never get a response (the client times out)
+        rateLimit -- maximum requests per second per thermostat before returning HTTP 503 (0 for no limit)
+        offlineRate -- fraction of thermostats that are unplugged (refuse connections and don't answer SSDP)
+        ssdp -- answer SSDP M-SEARCH requests
+        notifyInterval -- seconds between SSDP NOTIFY alive announcements (0 for none)
+        """
+
+        self.address = address
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.timeoutRate = timeoutRate
+        self.rateLimit = rateLimit
+        self.ssdp = ssdp
+        self.notifyInterval = notifyInterval
+        self.thermostats = [virtualThermostat(n, basePort + n, random.random() < offlineRate) for n in range(count)]
+        self._byPort = {thermostat.port: thermostat for thermostat in self.thermostats}
+        self._counters = {}
+        self._runner = None
+        self._transport = None
+        self._tasks = []
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    # returns a copy of the request counters (by endpoint and result)
+    def stats(self):
+        return dict(self._counters)
+
+    # clear the request counters
+    def resetStats(self):
+        self._counters.clear()
+
+    # returns the hostnames (address:port) of the online thermostats
+    def getHostNames(self):
+        return ["{}:{}".format(self.address, thermostat.port) for thermostat in self.thermostats if not thermostat.offline]
+
+    def _count(self, key):
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    # handle an API request for a virtual thermostat
+    async def _handle(self, request):
+
+        # return the request counters for the simulator (not counted as a request)
+        if request.path == "/sim/stats":
+            return web.json_response(self.stats())
+
+        thermostat = self._byPort[request.transport.get_extra_info("sockname")[1]]
+        endpoint = request.method + " " + request.path
+        self._count("requests")
+        self._count(endpoint)
+
+        # rate limit the requests per thermostat
+        if self.rateLimit:
+            now = time.monotonic()
+            thermostat.requestTimes = [t for t in thermostat.requestTimes if now - t < 1.0]
+            if len(thermostat.requestTimes) >= self.rateLimit:
+                self._count("rate_limited")
+                return web.Response(status=503, text="Busy")
+            thermostat.requestTimes.append(now)
+
+        # simulate network and processing latency, lost requests, and server errors
+        delay = max(self.latency + random.uniform(-self.jitter, self.jitter), 0.0)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.timeoutRate and random.random() < self.timeoutRate:
+            self._count("timeouts")
+            await asyncio.sleep(3600)
+        if self.errorRate and random.random() < self.errorRate:
+            self._count("errors")
+            return web.Response(status=500, text="Internal Server Error")
+
+        # control and settings parameters may be in the query string or the form body
+        params = dict(request.query)
+        if request.method == "POST" and request.can_read_body:
+            params.update(await request.post())
+
+        thermostat.update()
+        if endpoint == "GET /":
+            data = {"api_ver": 5, "type": "residential", "model": "COLORTOUCH", "firmware": "5.28"}
+        elif endpoint == "GET /query/info":
+            data = thermostat.state
+        elif endpoint == "GET /query/sensors":
+            data = {"sensors": thermostat.sensors}
+        elif endpoint == "GET /query/alerts":
+            data = {"alerts": thermostat.alerts}
+        elif endpoint == "GET /query/runtimes":
+            data = {"runtimes": thermostat.runtimes}
+        elif endpoint == "POST /control":
+            data = thermostat.setControls(params)
+        elif endpoint == "POST /settings":
+            data = thermostat.setSettings(params)
+        else:
+            return web.Response(status=404, text="Not Found")
+
+        return web.json_response(data)
+
+    # build the SSDP response or announcement for a thermostat
+    def _ssdpMessage(self, thermostat, notify=False):
+
+        if notify:
+            lines = ["NOTIFY * HTTP/1.1", "HOST: {}:{}".format(*_SSDP_GROUP), "NT: " + _SSDP_SEARCH_TARGET, "NTS: ssdp:alive"]
+        else:
+            lines = ["HTTP/1.1 200 OK", "ST: " + _SSDP_SEARCH_TARGET, "EXT:"]
+        lines.extend([
+            "CACHE-CONTROL: max-age={}".format(_SSDP_MAX_AGE),
+            "LOCATION: http://{}:{}/".format(self.address, thermostat.port),
+            "SERVER: Venstar ColorTouch Simulator",
+            "USN: " + thermostat.getUSN(),
+            "", ""
+        ])
+        return "\r\n".join(lines).encode("utf-8")
+
+    # answer SSDP M-SEARCH requests
+    def _ssdpReceived(self, data, addr):
+
+        if data.startswith(b"M-SEARCH") and (_SSDP_SEARCH_TARGET.encode() in data or b"ssdp:all" in data):
+            self._count("ssdp_searches")
+            for thermostat in self.thermostats:
+                if not thermostat.offline:
+                    self._transport.sendto(self._ssdpMessage(thermostat), addr)
+
+    # send SSDP NOTIFY alive announcements periodically
+    async def _ssdpNotify(self):
+
+        while True:
+            for thermostat in self.thermostats:
+                if not thermostat.offline:
+                    self._transport.sendto(self._ssdpMessage(thermostat, notify=True), _SSDP_GROUP)
+            await asyncio.sleep(self.notifyInterval)
+
+    # start the servers on the running event loop
+    async def start(self):
+
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        for thermostat in self.thermostats:
+            if not thermostat.offline:
+                await web.TCPSite(self._runner, self.address, thermostat.port, backlog=1024).start()
+
+        if self.ssdp:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("", _SSDP_GROUP[1]))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(_SSDP_GROUP[0]) + socket.inet_aton(self.address))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.address))
+            protocol = type("ssdpProtocol", (asyncio.DatagramProtocol,), {"datagram_received": lambda p, data, addr: self._ssdpReceived(data, addr)})
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(protocol, sock=sock)
+            if self.notifyInterval:
+                self._tasks.append(asyncio.ensure_future(self._ssdpNotify()))
+
+        _LOGGER.info("Simulating %i thermostat(s) on %s ports %i-%i.", len(self.thermostats), self.address, self.thermostats[0].port, self.thermostats[-1].port)
+
+    # stop the servers
+    async def stop(self):
+
+        for task in self._tasks:
+            task.cancel()
+        if self._transport is not None:
+            self._transport.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # run the simulator on its own event loop in a background thread (e.g., for benchmarks)
+    def startInThread(self):
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self.start())
+            self._ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="venstar-sim", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    # stop the simulator running in the background thread
+    def stopInThread(self):
+
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+# raise the open file limit as far as allowed, since each thermostat needs a listening socket and connections
+def raiseFileLimit():
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Main function to run the simulator from the command line
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate Venstar ColorTouch thermostats for testing.")
+    parser.add_argument("-n", "--count", type=int, default=1, help="number of thermostats (default 1)")
+    parser.add_argument("-a", "--address", default="127.0.0.1", help="local IP address to listen on (default 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="port for the first thermostat (default 8000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="maximum random variation of the response delay in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests returning HTTP 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="fraction of requests never answered")
+    parser.add_argument("--rate-limit", type=int, default=0, help="maximum requests per second per thermostat before HTTP 503")
+    parser.add_argument("--offline-rate", type=float, default=0.0, help="fraction of thermostats that are offline")
+    parser.add_argument("--no-ssdp", action="store_true", help="don't answer SSDP M-SEARCH requests")
+    parser.add_argument("--notify-interval", type=float, default=0, help="seconds between SSDP NOTIFY announcements (default none)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    raiseFileLimit()
+
+    simulator = thermostatSimulator(args.count, args.address, args.port, args.latency, args.jitter, args.error_rate,
+        args.timeout_rate, args.rate_limit, args.offline_rate, not args.no_ssdp, args.notify_interval)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(simulator.start())
+        loop.run_forever()
+    except KeyboardInterrupt:
+        _LOGGER.info("Request counts: %s", simulator.stats())
+    finally:
+        loop.run_until_complete(simulator.stop())
+        loop.close()
+        sys.exit(0)
@@ -6,16 +6,46 @@ by Goose66 (W. Randy King) kingwrandy@gmail.com
 
 import sys
 import logging 
-import requests
-import ssdp
+import json
+import asyncio
+import threading
+import time
+import socket
+import importlib.util
 from urllib.parse import unquote, urlparse
 
+# import a module when it is first used instead of when this module is imported
+# Note: keeps aiohttp (the largest import by far) and the discovery modules out of the nodeserver startup time
+def _lazyImport(name):
+
+    module = sys.modules.get(name)
+    if module is None:
+        spec = importlib.util.find_spec(name)
+        spec.loader = importlib.util.LazyLoader(spec.loader)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+
+    return module
+
+# Note: aiohttp is first used on the background event loop thread, so the lazy import is not raced by other threads
+aiohttp = _lazyImport("aiohttp")
+ssdp = _lazyImport("ssdp")
+
+# use the faster orjson decoder for API responses if it is installed
+try:
+    import orjson
+    _decodeJSON = orjson.loads
+except ImportError:
+    _decodeJSON = json.loads
+
 # Configure a module level logger for module testing
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.setLevel(logging.DEBUG)
 
 # Venstar ColorTouch Local REST API v4 spec.
 _API_HTTP_HEADERS = {}
+_API_URL_PREFIX = "http://{host_name}" # stripped from the API url to give the endpoint for metrics
 _API_GET_API_INFO = {
     "url": "http://{host_name}/",
     "method": "GET"
@@ -46,6 +76,7 @@ _API_SET_SETTINGS = {
 }
 
 _SSDP_SEARCH_TARGET = "colortouch:ecp"
+_SSDP_RETRANSMIT_SCHEDULE = (0.0, 1.0, 3.0) # offsets (in seconds) for sending the SSDP M-SEARCH
 
 THERMO_TYPE_RESIDENTIAL = "residential"
 THERMO_TYPE_COMMERCIAL = "commercial"
@@ -66,83 +97,542 @@ THERMO_MODE_HEAT = 1
 THERMO_MODE_COOL = 2
 THERMO_MODE_AUTO = 3
 
+# errors for the results of setMultipleThermostats()
+BULK_ERROR_OFFLINE = "offline" # thermostat state could not be retrieved
+BULK_ERROR_AWAY = "away" # controls or schedule can't be changed while the thermostat is in away mode
+BULK_ERROR_SETPOINT_DELTA = "setpointdelta" # heat and cool setpoints closer than the setpoint delta in auto mode
+BULK_ERROR_FAILED = "failed" # the thermostat did not accept the change
+
 # Timeout durations for HTTP calls - defined here for easy tweaking
 _HTTP_GET_TIMEOUT = 6.05
 _HTTP_POST_TIMEOUT = 4.05
 
-# interface class for a particular Venstart ColorTouch thermostat
-class thermostatConnection(object):
+# Circuit breaker settings for thermostats that stop responding
+_BREAKER_FAILURE_THRESHOLD = 3 # consecutive timeouts or connection errors before failing calls fast
+_BREAKER_BACKOFF_MIN = 10.0 # seconds before the first probe of a thermostat that stopped responding
+_BREAKER_BACKOFF_MAX = 300.0 # maximum seconds between probes
+_HTTP_PROBE_TIMEOUT = 2.05 # timeout for the probe call
+
+# Default settings for the keep-alive connection pool shared by all thermostat connections - see configureConnectionPool()
+_HTTP_POOL_SIZE = 100 # maximum open connections
+_HTTP_POOL_SIZE_PER_HOST = 3 # maximum open connections to each thermostat
+_HTTP_KEEPALIVE_TIMEOUT = 15.0 # seconds an idle connection is kept open for reuse
+_HTTP_CONNECT_TIMEOUT = 3.05 # timeout for opening a connection
+_HTTP_READ_TIMEOUT = None # timeout between reads of the response (None for only the overall GET/POST timeouts)
+
+# maximum number of thermostats changed at once by setMultipleThermostats() and queried at once by getMultipleThermostatDetails()
+_BULK_MAX_CONCURRENCY = 16
+
+# latency histogram buckets (in seconds) for the API call metrics
+_METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# error types counted by the API call metrics
+METRICS_ERROR_TIMEOUT = "timeout"
+METRICS_ERROR_CONNECTION = "connection"
+METRICS_ERROR_HTTP = "http"
+
+# latency and error metrics for the API calls, by host and endpoint
+class apiMetrics(object):
+
+    _endpoints = None
+    _lastSuccess = None
+    _connections = None
+    _lock = None
+
+    def __init__(self):
+
+        # metrics for each (host, endpoint), last successful call time for each host, and connections opened and reused for each host
+        self._endpoints = {}
+        self._lastSuccess = {}
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    # returns the metrics for the host and endpoint, creating them if needed
+    # Note: must be called with the lock held
+    def _getEndpoint(self, host, endpoint):
+
+        metrics = self._endpoints.get((host, endpoint))
+        if metrics is None:
+            metrics = {
+                "buckets": [0] * len(_METRICS_LATENCY_BUCKETS),
+                "count": 0,
+                "sum": 0.0,
+                "bytes": 0,
+                "errors": {METRICS_ERROR_TIMEOUT: 0, METRICS_ERROR_CONNECTION: 0, METRICS_ERROR_HTTP: 0},
+            }
+            self._endpoints[(host, endpoint)] = metrics
+        
+        return metrics
+
+    # record a completed API call
+    def recordSuccess(self, host, endpoint, seconds, bytesReceived):
+
+        with self._lock:
+            metrics = self._getEndpoint(host, endpoint)
+            metrics["count"] += 1
+            metrics["sum"] += seconds
+            metrics["bytes"] += bytesReceived
+            for i, bound in enumerate(_METRICS_LATENCY_BUCKETS):
+                if seconds <= bound:
+                    metrics["buckets"][i] += 1
+                    break
+            self._lastSuccess[host] = time.time()
+
+    # record a failed API call
+    def recordError(self, host, endpoint, errorType):
+
+        with self._lock:
+            self._getEndpoint(host, endpoint)["errors"][errorType] += 1
+
+    # record a connection opened or reused from the pool for an API call
+    def recordConnection(self, host, reused):
+
+        with self._lock:
+            connections = self._connections.setdefault(host, {"opened": 0, "reused": 0})
+            connections["reused" if reused else "opened"] += 1
+
+    def getConnectionSummary(self):
+        """Returns the total numbers of connections opened and reused from the pool
+
+        Returns:
+        dictionary with opened and reused counts
+        """
+
+        with self._lock:
+            return {
+                "opened": sum(connections["opened"] for connections in self._connections.values()),
+                "reused": sum(connections["reused"] for connections in self._connections.values()),
+            }
+
+    def getHostSummary(self):
+        """Returns summary of API calls by host
+
+        Returns:
+        dictionary by host of dictionaries with calls, errors, mean latency (seconds), and last success (epoch time or None)
+        """
+
+        summary = {}
+        with self._lock:
+            for (host, endpoint), metrics in self._endpoints.items():
+                hostSummary = summary.setdefault(host, {"calls": 0, "errors": 0, "seconds": 0.0, "lastSuccess": self._lastSuccess.get(host)})
+                hostSummary["calls"] += metrics["count"]
+                hostSummary["errors"] += sum(metrics["errors"].values())
+                hostSummary["seconds"] += metrics["sum"]
+
+        for hostSummary in summary.values():
+            seconds = hostSummary.pop("seconds")
+            hostSummary["meanLatency"] = seconds / hostSummary["calls"] if hostSummary["calls"] else None
+
+        return summary
+
+    def getPrometheusText(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+
+        latency = ["# HELP venstar_api_request_duration_seconds Latency of completed thermostat API calls.", "# TYPE venstar_api_request_duration_seconds histogram"]
+        errors = ["# HELP venstar_api_errors_total Failed thermostat API calls by error type.", "# TYPE venstar_api_errors_total counter"]
+        received = ["# HELP venstar_api_received_bytes_total Bytes received from thermostat API calls.", "# TYPE venstar_api_received_bytes_total counter"]
+        lastSuccess = ["# HELP venstar_api_last_success_timestamp_seconds Time of the last successful API call to the thermostat.", "# TYPE venstar_api_last_success_timestamp_seconds gauge"]
+        connections = ["# HELP venstar_api_connections_total HTTP connections to the thermostat opened or reused from the keep-alive pool.", "# TYPE venstar_api_connections_total counter"]
+
+        with self._lock:
+            for (host, endpoint), metrics in sorted(self._endpoints.items()):
+                labels = 'host="{}",endpoint="{}"'.format(host, endpoint)
+                cumulative = 0
+                for bound, count in zip(_METRICS_LATENCY_BUCKETS, metrics["buckets"]):
+                    cumulative += count
+                    latency.append('venstar_api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+                latency.append('venstar_api_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, metrics["count"]))
+                latency.append("venstar_api_request_duration_seconds_sum{{{}}} {:.6f}".format(labels, metrics["sum"]))
+                latency.append("venstar_api_request_duration_seconds_count{{{}}} {}".format(labels, metrics["count"]))
+                for errorType, count in sorted(metrics["errors"].items()):
+                    errors.append('venstar_api_errors_total{{{},type="{}"}} {}'.format(labels, errorType, count))
+                received.append("venstar_api_received_bytes_total{{{}}} {}".format(labels, metrics["bytes"]))
+            for host, timestamp in sorted(self._lastSuccess.items()):
+                lastSuccess.append('venstar_api_last_success_timestamp_seconds{{host="{}"}} {:.3f}'.format(host, timestamp))
+            for host, counts in sorted(self._connections.items()):
+                connections.append('venstar_api_connections_total{{host="{}",reused="false"}} {}'.format(host, counts["opened"]))
+                connections.append('venstar_api_connections_total{{host="{}",reused="true"}} {}'.format(host, counts["reused"]))
+
+        return "\n".join(latency + errors + received + lastSuccess + connections) + "\n"
+
+# metrics for all of the API calls made by the module
+metrics = apiMetrics()
+
+def startMetricsServer(port, address=""):
+    """Starts serving the API call metrics at /metrics for Prometheus in a background thread
+
+    Parameters:
+    port -- TCP port to listen on
+    address -- local address to listen on (defaults to all)
+    Returns:
+    the HTTP server (call shutdown() to stop)
+    """
+
+    # import the HTTP server only when the metrics are served
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    # HTTP request handler for the metrics server
+    class metricsRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics.getPrometheusText().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # keep the server's request logging out of the log
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), metricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metricsServer", daemon=True).start()
+
+    return server
+
+# returns the metrics error type for an exception from an HTTP call
+def _getErrorType(e):
+
+    if isinstance(e, aiohttp.ClientResponseError):
+        return METRICS_ERROR_HTTP
+    elif isinstance(e, asyncio.TimeoutError):
+        return METRICS_ERROR_TIMEOUT
+    else:
+        return METRICS_ERROR_CONNECTION
+
+# event loop (running in a background thread) used by the synchronous interface class
+_eventLoop = None
+_eventLoopLock = threading.Lock()
+
+# keep-alive HTTP sessions shared by all thermostat connections, one per event loop
+_sharedSessions = {}
+
+# settings for the connection pool of the shared sessions
+_poolSettings = {
+    "poolSize": _HTTP_POOL_SIZE,
+    "poolSizePerHost": _HTTP_POOL_SIZE_PER_HOST,
+    "keepAliveTimeout": _HTTP_KEEPALIVE_TIMEOUT,
+    "connectTimeout": _HTTP_CONNECT_TIMEOUT,
+    "readTimeout": _HTTP_READ_TIMEOUT,
+}
+
+def configureConnectionPool(poolSize=None, poolSizePerHost=None, keepAliveTimeout=None, connectTimeout=None, readTimeout=None):
+    """Configures the keep-alive connection pool shared by discovery, polling, and commands
+
+    Parameters:
+    poolSize -- maximum number of open connections (0 for no limit)
+    poolSizePerHost -- maximum number of open connections to each thermostat (0 for no limit)
+    keepAliveTimeout -- seconds an idle connection is kept open for reuse
+    connectTimeout -- timeout (in seconds) for opening a connection
+    readTimeout -- timeout (in seconds) between reads of the response
+    Note: applies to shared sessions created afterwards, so call before the first API call. Parameters left as None keep their current values.
+    """
+
+    settings = {"poolSize": poolSize, "poolSizePerHost": poolSizePerHost, "keepAliveTimeout": keepAliveTimeout, "connectTimeout": connectTimeout, "readTimeout": readTimeout}
+    _poolSettings.update({key: value for key, value in settings.items() if value is not None})
+
+# returns the timeout settings for an API call with the specified overall timeout
+def _getTimeout(total):
+    return aiohttp.ClientTimeout(total=total, connect=_poolSettings["connectTimeout"], sock_read=_poolSettings["readTimeout"])
+
+# count connections opened and reused by the shared sessions in the API metrics
+# Note: the host is passed in the trace request context of each API call
+async def _onConnectionCreated(session, context, params):
+    if context.trace_request_ctx:
+        metrics.recordConnection(context.trace_request_ctx["host"], False)
+
+async def _onConnectionReused(session, context, params):
+    if context.trace_request_ctx:
+        metrics.recordConnection(context.trace_request_ctx["host"], True)
+
+# returns the background event loop for the synchronous interface, starting it if needed
+def _getEventLoop():
+
+    global _eventLoop
+
+    with _eventLoopLock:
+        if _eventLoop is None:
+            _eventLoop = asyncio.new_event_loop()
+            threading.Thread(target=_eventLoop.run_forever, name="venstarapi-loop", daemon=True).start()
+
+    return _eventLoop
+
+# run a coroutine on the background event loop and wait for the result
+def _runSync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _getEventLoop()).result()
+
+# returns the shared HTTP session for the running event loop, creating it if needed
+async def _getSharedSession():
+
+    loop = asyncio.get_running_loop()
+    session = _sharedSessions.get(loop)
+    if session is None or session.closed:
+        traceConfig = aiohttp.TraceConfig()
+        traceConfig.on_connection_create_end.append(_onConnectionCreated)
+        traceConfig.on_connection_reuseconn.append(_onConnectionReused)
+        connector = aiohttp.TCPConnector(
+            limit=_poolSettings["poolSize"],
+            limit_per_host=_poolSettings["poolSizePerHost"],
+            keepalive_timeout=_poolSettings["keepAliveTimeout"]
+        )
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[traceConfig])
+        _sharedSessions[loop] = session
+
+    return session
+
+async def closeSharedSession():
+    """Closes the shared HTTP session for the running event loop"""
+
+    session = _sharedSessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+def shutdown():
+    """Closes the shared HTTP session used by the synchronous interface class"""
+
+    if _eventLoop is not None:
+        _runSync(closeSharedSession())
+
+# response data returned from the HTTP call, read fully before the connection is released to the pool
+class _apiResponse(object):
+
+    status_code = 0
+    content = b""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return _decodeJSON(self.content)
+
+# state of a thermostat from /query/info, projected to the properties used by the nodeserver
+# Note: types are converted once when the state is parsed, and the [] and get() methods of the
+# original dictionary are supported
+class thermostatState(object):
+
+    # properties with their types, required properties first
+    _REQUIRED = (("mode", int), ("state", int), ("fan", int), ("fanstate", int), ("tempunits", int), ("away", int),
+        ("spacetemp", float), ("heattemp", float), ("cooltemp", float))
+    _OPTIONAL = (("schedule", int), ("schedulepart", int), ("setpointdelta", float), ("hum", float))
+
+    __slots__ = tuple(name for name, type in _REQUIRED + _OPTIONAL)
+
+    def __init__(self, data):
+
+        # raises KeyError, TypeError, or ValueError for missing or invalid properties
+        for name, type in self._REQUIRED:
+            setattr(self, name, type(data[name]))
+        for name, type in self._OPTIONAL:
+            value = data.get(name)
+            setattr(self, name, None if value is None else type(value))
+
+    def __getitem__(self, name):
+        value = getattr(self, name, None) if name in self.__slots__ else None
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return name in self.__slots__ and getattr(self, name) is not None
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in self.__slots__ else None
+        return default if value is None else value
+
+    def __eq__(self, other):
+        return isinstance(other, thermostatState) and all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr({name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None})
+
+# asyncio interface class for a particular Venstar ColorTouch thermostat
+class asyncThermostatConnection(object):
 
     _hostname = ""
     _pin = ""
     _session = None
     _logger = None
+    _stateCache = None
+    _stateCacheTime = 0.0
+    _stateGeneration = 0
+    _failures = 0
+    _breakerBackoff = _BREAKER_BACKOFF_MIN
+    _breakerProbeTime = 0.0
+    _probing = False
 
     # Primary constructor method
-    def __init__(self, hostname, pin="", logger=_LOGGER):
+    def __init__(self, hostname, pin="", logger=_LOGGER, session=None):
 
         self._hostname = hostname
         self._pin = pin
         self._logger = logger
 
-        # open an HTTP session
-        self._session = requests.Session()
+        # use the specified HTTP session, otherwise the shared session is used for each call 
+        self._session = session
+
+    # change the hostname (e.g., new IP address) for the connection
+    def setHostName(self, hostname):
+        self._hostname = hostname
+
+        # give the thermostat a chance at the new address
+        self._breakerProbeTime = 0.0
+
+    # returns the hostname for the connection
+    def getHostName(self):
+        return self._hostname
+
+    # returns False if calls to the thermostat are failing fast because it stopped responding
+    def isOnline(self):
+        return self._failures < _BREAKER_FAILURE_THRESHOLD
+
+    # check if a call to the thermostat should be made (circuit breaker)
+    async def _checkBreaker(self):
+
+        # breaker is closed if the thermostat is responding
+        if self.isOnline():
+            return True
+
+        # fail fast until it is time to probe the thermostat again (or while another call is probing it)
+        if self._probing or time.monotonic() < self._breakerProbeTime:
+            return False
+
+        # probe the thermostat with a cheap call with a short timeout
+        self._probing = True
+        try:
+            session = self._session or await _getSharedSession()
+            await _getAPIData(session, _API_GET_API_INFO, self._hostname, _HTTP_PROBE_TIMEOUT)
+
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError):
+            
+            # still not responding - back off the next probe
+            self._breakerBackoff = min(self._breakerBackoff * 2, _BREAKER_BACKOFF_MAX)
+            self._breakerProbeTime = time.monotonic() + self._breakerBackoff
+            self._logger.debug("Thermostat at %s still not responding - next probe in %.0f seconds.", self._hostname, self._breakerBackoff)
+            return False
+
+        finally:
+            self._probing = False
+
+        # responding again - close the breaker
+        self._logger.info("Thermostat at %s is responding again.", self._hostname)
+        self._failures = 0
+        self._breakerBackoff = _BREAKER_BACKOFF_MIN
+        return True
 
     # Call the specified REST API
-    def _call_api(self, api, params=None):
+    async def _call_api(self, api, params=None):
       
         method = api["method"]
         url = api["url"].format(host_name = self._hostname)
+        endpoint = api["url"][len(_API_URL_PREFIX):]
+
+        # fail fast if the thermostat stopped responding
+        if not await self._checkBreaker():
+            self._logger.debug("HTTP %s %s skipped - thermostat not responding.", method, url)
+            return False
 
         # uncomment the next line to dump HTTP request data to log file for debugging
-        self._logger.debug("HTTP %s data: %s", method + " " + url, params)
+        self._logger.debug("HTTP %s %s data: %s", method, url, params)
+
+        session = self._session or await _getSharedSession()
 
         try:
-            response = self._session.request(
+            startTime = time.monotonic()
+            async with session.request(
                 method,
                 url,
                 params = params, 
                 headers = _API_HTTP_HEADERS, # same every call     
-                timeout= _HTTP_POST_TIMEOUT if method == "POST" else _HTTP_GET_TIMEOUT
-            )
+                timeout = _getTimeout(_HTTP_POST_TIMEOUT if method == "POST" else _HTTP_GET_TIMEOUT),
+                trace_request_ctx = {"host": self._hostname}
+            ) as r:
             
-            # raise any codes other than 200, 201, and 401 for error handling 
-            if response.status_code not in (200, 201, 401):
-                response.raise_for_status()
+                # raise any codes other than 200, 201, and 401 for error handling 
+                if r.status not in (200, 201, 401):
+                    r.raise_for_status()
+
+                response = _apiResponse(r.status, await r.read())
+
+            metrics.recordSuccess(self._hostname, endpoint, time.monotonic() - startTime, len(response.content))
+            self._failures = 0
 
         # Allow timeout and connection errors to be ignored - log and return false
-        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-            self._logger.warning("HTTP %s in _call_api() failed: %s", method, str(e))
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+            errorType = _getErrorType(e)
+            metrics.recordError(self._hostname, endpoint, errorType)
+            self._logger.warning("HTTP %s in _call_api() failed: %s", method, str(e) or type(e).__name__)
+
+            # open the circuit breaker after too many consecutive timeouts or connection errors
+            if errorType != METRICS_ERROR_HTTP:
+                self._failures += 1
+                if self._failures == _BREAKER_FAILURE_THRESHOLD:
+                    self._breakerBackoff = _BREAKER_BACKOFF_MIN
+                    self._breakerProbeTime = time.monotonic() + self._breakerBackoff
+                    self._logger.warning("Thermostat at %s not responding - failing calls until it responds again.", self._hostname)
+
             return False
         except:
             self._logger.error("Unexpected error occured: %s", sys.exc_info()[0])
             raise
 
         # uncomment the next line to dump HTTP response to log file for debugging
-        self._logger.debug("HTTP response code: %d data: %s", response.status_code, response.text)
+        # Note: only decode the response text if it will be logged
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("HTTP response code: %d data: %s", response.status_code, response.text)
 
         return response
 
+    # invalidate the cached state, including the state from any query in progress, when a change is sent to the thermostat
+    def _invalidateState(self):
+        self._stateCache = None
+        self._stateGeneration += 1
+
     # Get state information for the thermostat
-    def getThermostatState(self):
+    async def getThermostatState(self, maxAge=None):
         """Returns the current state of the thermostat
 
+        Parameters:
+        maxAge -- if specified, return the cached state from the last call if it is no older than maxAge seconds 
         Returns:
-        dictionary of state properties for the thermostat
+        thermostatState with the state properties for the thermostat
         """
 
         self._logger.debug("in API getThermostatState()...")
 
+        # return the cached state if it is fresh enough
+        if maxAge is not None and self._stateCache is not None and time.monotonic() - self._stateCacheTime <= maxAge:
+            return self._stateCache
+
         # call the session API with the parameters
-        response  = self._call_api(_API_GET_THERMOSTAT_INFO)
+        generation = self._stateGeneration
+        response  = await self._call_api(_API_GET_THERMOSTAT_INFO)
         
         # if data returned, return the state properties
         if response and response.status_code == 200:
             
             # test the response data
             try:
-                respData = response.json()
-                return respData
+                state = thermostatState(response.json())
+
+                # don't cache the state if a change was sent to the thermostat while it was being queried
+                if generation == self._stateGeneration:
+                    self._stateCache = state
+                    self._stateCacheTime = time.monotonic()
+                return state
             except:
                 self._logger.warning("Thermostat at %s returned bad data in getThermostatState().", self._hostname)
                 return False                
@@ -152,7 +642,7 @@ class thermostatConnection(object):
             return False
 
     # Gets the alert status(es) for the the thermostat
-    def getThermostatAlerts(self):
+    async def getThermostatAlerts(self):
         """Returns the state of the alerts setup for the thermostat
 
         Returns:
@@ -162,7 +652,7 @@ class thermostatConnection(object):
         self._logger.debug("in API getThermostatAlerts()...")
    
         # get state of alerts
-        response  = self._call_api(_API_GET_ALERTS)
+        response  = await self._call_api(_API_GET_ALERTS)
 
         # if data returned, return the alert states
         if response and response.status_code == 200:
@@ -180,7 +670,7 @@ class thermostatConnection(object):
             return False
 
     # Get the temps from the remote sensors
-    def getSensorStates(self):
+    async def getSensorStates(self):
         """Returns the temps from the sensors
 
         Returns:
@@ -190,7 +680,7 @@ class thermostatConnection(object):
         self._logger.debug("in API getSensorState()...")
         
         # get the temperature sensor state
-        response  = self._call_api(_API_GET_SENSOR_INFO)
+        response  = await self._call_api(_API_GET_SENSOR_INFO)
 
         # if data returned, return the sensor states
         if response and response.status_code == 200:
@@ -207,8 +697,46 @@ class thermostatConnection(object):
         else:
             return False
 
+    # Get the runtimes for the last 7 days
+    async def getThermostatRuntimes(self):
+        """Returns the runtimes of the HVAC stages for the last 7 days
+
+        Returns:
+        dictionary with array of daily runtime records (ts, heat1, heat2, cool1, cool2, aux1, aux2, fc), oldest first
+        """
+
+        self._logger.debug("in API getThermostatRuntimes()...")
+        
+        # get the runtimes
+        response  = await self._call_api(_API_GET_RUNTIMES)
+
+        # if data returned, return the runtimes
+        if response and response.status_code == 200:
+
+            # test the response data
+            try:
+                respData = response.json()
+                return respData
+            except:
+                self._logger.warning("Thermostat at %s returned bad data in getThermostatRuntimes().", self._hostname)
+                return False      
+
+        # otherwise return error (False)
+        else:
+            return False
+
+    # Get the alerts, sensor states, and runtimes concurrently
+    async def getThermostatDetails(self):
+        """Returns the alerts, sensor states, and runtimes for the thermostat, queried concurrently
+
+        Returns:
+        tuple of the results of getThermostatAlerts(), getSensorStates(), and getThermostatRuntimes()
+        """
+
+        return tuple(await asyncio.gather(self.getThermostatAlerts(), self.getSensorStates(), self.getThermostatRuntimes()))
+
     # Toggle the state of a pump or heater - returns system state information
-    def setThermostatControls(self, mode=None, fan=None, heattemp=None, cooltemp=None):
+    async def setThermostatControls(self, mode=None, fan=None, heattemp=None, cooltemp=None):
         """Set the control modes and setpoints for the thermostat
 
         Parameters:
@@ -234,7 +762,8 @@ class thermostatConnection(object):
            params.update({"cooltemp": cooltemp})
 
         # call the control API with the specified parameters
-        response  = self._call_api(_API_SET_CONTROL, params=params)
+        self._invalidateState()
+        response  = await self._call_api(_API_SET_CONTROL, params=params)
         
         if response and response.status_code == 200:
 
@@ -244,8 +773,9 @@ class thermostatConnection(object):
                 self._logger.warning("Error message returned from control API: %s", respData["reason"])
                 return False
             
-            # other return True
+            # other invalidate the cached state and return True
             else:
+                self._invalidateState()
                 return True
 
         # otherwise return False to indicate previously logged failure
@@ -253,7 +783,7 @@ class thermostatConnection(object):
             return False
 
     # Toggle the state of a pump or heater - returns system state information
-    def setThermostatSettings(self, setting, value):
+    async def setThermostatSettings(self, setting, value):
         """Sets specific setting for the thermostat
 
         Parameters:
@@ -276,9 +806,8 @@ class thermostatConnection(object):
         } 
 
         # call the settings API with the specified parameters
-        response  = self._call_api(_API_SET_SETTINGS, params=params)
-
-        print(response.text)
+        self._invalidateState()
+        response  = await self._call_api(_API_SET_SETTINGS, params=params)
 
         if response and response.status_code == 200:
     
@@ -288,136 +817,726 @@ class thermostatConnection(object):
                 self._logger.warning("Error message returned from settings API: %s", respData["reason"])
                 return False
             
-            # other return True
+            # other invalidate the cached state and return True
             else:
+                self._invalidateState()
                 return True
 
         # otherwise return False to indicate previously logged failure
         else:
             return False
 
+    # close any HTTP session
+    # Note: the shared session stays open for the other connections - see closeSharedSession()
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+# synchronous interface class for a particular Venstar ColorTouch thermostat
+# Note: thin wrapper running the asyncio interface class on a shared background event loop
+class thermostatConnection(object):
+
+    _conn = None
+
+    # Primary constructor method
+    def __init__(self, hostname, pin="", logger=_LOGGER):
+        self._conn = asyncThermostatConnection(hostname, pin, logger)
+
+    # change the hostname (e.g., new IP address) for the connection
+    def setHostName(self, hostname):
+        self._conn.setHostName(hostname)
+
+    # returns the hostname for the connection
+    def getHostName(self):
+        return self._conn.getHostName()
+
+    # returns False if calls to the thermostat are failing fast because it stopped responding
+    def isOnline(self):
+        return self._conn.isOnline()
+
+    # Get state information for the thermostat
+    def getThermostatState(self, maxAge=None):
+        """Returns the current state of the thermostat - see asyncThermostatConnection.getThermostatState()"""
+        return _runSync(self._conn.getThermostatState(maxAge))
+
+    # Gets the alert status(es) for the the thermostat
+    def getThermostatAlerts(self):
+        """Returns the state of the alerts setup for the thermostat - see asyncThermostatConnection.getThermostatAlerts()"""
+        return _runSync(self._conn.getThermostatAlerts())
+
+    # Get the temps from the remote sensors
+    def getSensorStates(self):
+        """Returns the temps from the sensors - see asyncThermostatConnection.getSensorStates()"""
+        return _runSync(self._conn.getSensorStates())
+
+    # Get the runtimes for the last 7 days
+    def getThermostatRuntimes(self):
+        """Returns the runtimes of the HVAC stages for the last 7 days - see asyncThermostatConnection.getThermostatRuntimes()"""
+        return _runSync(self._conn.getThermostatRuntimes())
+
+    # Get the alerts, sensor states, and runtimes concurrently
+    def getThermostatDetails(self):
+        """Returns the alerts, sensor states, and runtimes for the thermostat - see asyncThermostatConnection.getThermostatDetails()"""
+        return _runSync(self._conn.getThermostatDetails())
+
+    # Set the control modes and setpoints for the thermostat
+    def setThermostatControls(self, mode=None, fan=None, heattemp=None, cooltemp=None):
+        """Set the control modes and setpoints for the thermostat - see asyncThermostatConnection.setThermostatControls()"""
+        return _runSync(self._conn.setThermostatControls(mode, fan, heattemp, cooltemp))
+
+    # Sets specific setting for the thermostat
+    def setThermostatSettings(self, setting, value):
+        """Sets specific setting for the thermostat - see asyncThermostatConnection.setThermostatSettings()"""
+        return _runSync(self._conn.setThermostatSettings(setting, value))
+
     # close any HTTP session
     def close(self):
-        self._session.close()
+        _runSync(self._conn.close())
             
-def getThermostatInfo(hostName, logger=_LOGGER):
-    """Make call to check thermostat and receive API info - for external calling
+# apply a change to one thermostat for setMultipleThermostatsAsync()
+async def _applyThermostatChange(conn, change, maxAge):
+
+    # get the state of the thermostat to fill in the settings not changed and to validate the change
+    thermostatState = await conn.getThermostatState(maxAge)
+    if not thermostatState:
+        return {"success": False, "error": BULK_ERROR_OFFLINE}
+
+    away = thermostatState["away"]
+
+    # change the away state first, since the controls can't be changed in away mode
+    if "away" in change and change["away"] != away:
+        if not await conn.setThermostatSettings(THERMO_SETTING_AWAY_STATE, change["away"]):
+            return {"success": False, "error": BULK_ERROR_FAILED}
+        away = change["away"]
+
+    # change the controls, filling in the mode and setpoints not changed from the current state
+    controls = {key: change[key] for key in ("mode", "fan", "heattemp", "cooltemp") if key in change}
+    if controls:
+
+        if away == 1:
+            return {"success": False, "error": BULK_ERROR_AWAY}
+
+        mode = controls.setdefault("mode", thermostatState["mode"])
+        heatTemp = controls.setdefault("heattemp", thermostatState["heattemp"])
+        coolTemp = controls.setdefault("cooltemp", thermostatState["cooltemp"])
+
+        # make sure the cool setpoint is above the heat setpoint by the setpoint delta in auto mode
+        if mode == THERMO_MODE_AUTO and (coolTemp - heatTemp) < thermostatState.get("setpointdelta", 0):
+            return {"success": False, "error": BULK_ERROR_SETPOINT_DELTA}
+
+        if not await conn.setThermostatControls(**controls):
+            return {"success": False, "error": BULK_ERROR_FAILED}
+
+    # change the schedule state
+    if "schedule" in change:
+
+        if away == 1:
+            return {"success": False, "error": BULK_ERROR_AWAY}
+
+        if not await conn.setThermostatSettings(THERMO_SETTING_SCHEDULE_STATE, change["schedule"]):
+            return {"success": False, "error": BULK_ERROR_FAILED}
+
+    return {"success": True, "error": None}
+
+# apply changes to multiple thermostats concurrently
+async def setMultipleThermostatsAsync(changes, maxAge=None, maxConcurrency=_BULK_MAX_CONCURRENCY, logger=_LOGGER):
+    """Applies control and setting changes to multiple thermostats concurrently
 
     Parameters:
-    hostName -- host name or IP address of thermostat
+    changes -- list of (asyncThermostatConnection, change) tuples, where change is a dictionary with any of:
+        away - away state: 0-Home, 1-Away
+        mode - thermostat mode: 0-Off, 1-Heat, 2-Cool, 3-Auto
+        fan - fan mode: 0-Auto, 1-On
+        heattemp - heat to temperature
+        cooltemp - cool to temperature
+        schedule - schedule state: 0-off, 1-On
+    maxAge -- maximum age (in seconds) of a cached thermostat state used to validate the changes (defaults to querying each thermostat)
+    maxConcurrency -- maximum number of thermostats changed at once
+    logger -- logger to use for errors
     Returns:
-    dictionary of API properties for the thermostat or False if error occurred
+    list of the results for the changes, in the same order, each a dictionary with "success" (boolean) and "error" (BULK_ERROR_* value or None)
+    Note: the away state is changed first, then the controls (mode, fan, and setpoints in one call), then the schedule state
     """
 
-    logger.debug("in getThermostatInfo()...")
+    semaphore = asyncio.Semaphore(maxConcurrency)
 
-    try:
-        # Call the REST API to get the api version info
-        response = requests.request(_API_GET_API_INFO["method"],
-            _API_GET_API_INFO["url"].format(host_name = hostName),
-            headers = _API_HTTP_HEADERS, # same every call     
-            timeout= _HTTP_GET_TIMEOUT
-        )
+    async def applyChange(conn, change):
+        async with semaphore:
+            result = await _applyThermostatChange(conn, change, maxAge)
+        if not result["success"]:
+            logger.warning("Change %s to thermostat at %s failed: %s", str(change), conn.getHostName(), result["error"])
+        return result
 
-        # raise anything other than a successful (200) HTTP code to error handling
-        response.raise_for_status()
+    return await asyncio.gather(*[applyChange(conn, change) for conn, change in changes])
 
-    # For errors that may indicate a bad hostName, log a warning and return false
-    except(requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-        logger.warning("HTTP GET in getThermostatInfo() failed: %s", str(e))
-        return False
-    except:
-        logger.exception("Unexpected error from HTTP call in getThermostatInfo(): %s", sys.exc_info()[0])
-        raise
-    
-    thermostatInfo = response.json()
+# apply changes to multiple thermostats concurrently (synchronous interface)
+def setMultipleThermostats(changes, maxAge=None, maxConcurrency=_BULK_MAX_CONCURRENCY, logger=_LOGGER):
+    """Applies control and setting changes to multiple thermostats concurrently - see setMultipleThermostatsAsync()
+
+    Parameters:
+    changes -- list of (thermostatConnection, change) tuples
+    """
+    return _runSync(setMultipleThermostatsAsync([(conn._conn, change) for conn, change in changes], maxAge, maxConcurrency, logger))
+
+# query the details of multiple thermostats concurrently
+async def getMultipleThermostatDetailsAsync(connections, maxConcurrency=_BULK_MAX_CONCURRENCY):
+    """Returns the alerts, sensor states, and runtimes for multiple thermostats, queried concurrently
+
+    Parameters:
+    connections -- list of asyncThermostatConnection objects
+    maxConcurrency -- maximum number of thermostats queried at once
+    Returns:
+    list of the results of getThermostatDetails() for the connections, in the same order
+    """
+
+    semaphore = asyncio.Semaphore(maxConcurrency)
+
+    async def getDetails(conn):
+        async with semaphore:
+            return await conn.getThermostatDetails()
+
+    return await asyncio.gather(*[getDetails(conn) for conn in connections])
+
+# query the details of multiple thermostats concurrently (synchronous interface)
+def getMultipleThermostatDetails(connections, maxConcurrency=_BULK_MAX_CONCURRENCY):
+    """Returns the alerts, sensor states, and runtimes for multiple thermostats - see getMultipleThermostatDetailsAsync()
+
+    Parameters:
+    connections -- list of thermostatConnection objects
+    """
+    return _runSync(getMultipleThermostatDetailsAsync([conn._conn for conn in connections], maxConcurrency))
+
+# get the JSON data from the specified REST API (for discovery calls not tied to a connection object)
+async def _getAPIData(session, api, hostName, timeout=_HTTP_GET_TIMEOUT):
+
+    endpoint = api["url"][len(_API_URL_PREFIX):]
 
-    # get remaining thermostat info from the thermostat state API 
     try:
-        # Call the REST API to get the thermostat info
-        response = requests.request(
-            _API_GET_THERMOSTAT_INFO["method"],
-            _API_GET_THERMOSTAT_INFO["url"].format(host_name = hostName),
+        startTime = time.monotonic()
+        async with session.request(
+            api["method"],
+            api["url"].format(host_name = hostName),
             headers = _API_HTTP_HEADERS, # same every call     
-            timeout= _HTTP_GET_TIMEOUT
-        )
+            timeout = _getTimeout(timeout),
+            trace_request_ctx = {"host": hostName}
+        ) as response:
 
-        # raise anything other than a successful (200) HTTP code to error handling
-        response.raise_for_status()
+            # raise anything other than a successful (200) HTTP code to error handling
+            response.raise_for_status()
 
-    # For errors that may indicate a bad hostName, log a warning and return false
-    except(requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-        logger.warning("HTTP GET in getThermostatInfo() failed: %s", str(e))
-        return False
-    except:
-        logger.exception("Unexpected error from HTTP call in getThermostatInfo(): %s", sys.exc_info()[0])
+            content = await response.read()
+
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+        metrics.recordError(hostName, endpoint, _getErrorType(e))
         raise
-    
-    # add the additional info
-    thermostatInfo.update(response.json())
 
-    # get a list of the sensors setup for the thermostat
+    metrics.recordSuccess(hostName, endpoint, time.monotonic() - startTime, len(content))
+
+    return _decodeJSON(content)
+
+async def getThermostatInfoAsync(hostName, logger=_LOGGER):
+    """Make calls to check thermostat and receive API info - for external calling
+
+    Parameters:
+    hostName -- host name or IP address of thermostat
+    Returns:
+    dictionary of API properties for the thermostat or False if error occurred
+    """
+
+    logger.debug("in getThermostatInfo()...")
+
+    session = await _getSharedSession()
+
     try:
-        # Call the REST API to get the sensor info
-        response = requests.request(
-            _API_GET_SENSOR_INFO["method"],
-            _API_GET_SENSOR_INFO["url"].format(host_name = hostName),
-            headers = _API_HTTP_HEADERS, # same every call     
-            timeout= _HTTP_GET_TIMEOUT
+        # Call the REST APIs to get the api version info, thermostat info, and the list of sensors concurrently
+        results = await asyncio.gather(
+            _getAPIData(session, _API_GET_API_INFO, hostName),
+            _getAPIData(session, _API_GET_THERMOSTAT_INFO, hostName),
+            _getAPIData(session, _API_GET_SENSOR_INFO, hostName),
+            return_exceptions=True
         )
 
-        # raise anything other than a successful (200) HTTP code to error handling
-        response.raise_for_status()
+        # raise the first error from any of the calls to error handling
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
     # For errors that may indicate a bad hostName, log a warning and return false
-    except(requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.HTTPError) as e:
-        logger.warning("HTTP GET in getThermostatInfo() failed: %s", str(e))
+    except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+        logger.warning("HTTP GET in getThermostatInfo() failed: %s", str(e) or type(e).__name__)
         return False
     except:
         logger.exception("Unexpected error from HTTP call in getThermostatInfo(): %s", sys.exc_info()[0])
         raise
-    
-    # add the sensor info
-    thermostatInfo.update(response.json())
+
+    # combine the api version info, the thermostat info, and the sensor info
+    thermostatInfo = {}
+    for result in results:
+        thermostatInfo.update(result)
 
     # return the thermostat info
     return thermostatInfo
+
+def getThermostatInfo(hostName, logger=_LOGGER):
+    """Make calls to check thermostat and receive API info - see getThermostatInfoAsync()"""
+
+    return _runSync(getThermostatInfoAsync(hostName, logger))
+
+def probeThermostat(hostName, logger=_LOGGER):
+    """Start the calls to check thermostat and receive API info in the background
+
+    Parameters:
+    hostName -- host name or IP address of thermostat
+    Returns:
+    concurrent.futures.Future for the result of getThermostatInfo()
+    """
+
+    return asyncio.run_coroutine_threadsafe(getThermostatInfoAsync(hostName, logger), _getEventLoop())
    
-# discover devices 
-def discoverThermostats(timeout=5, logger=_LOGGER):
-    """Discover thermostats on the network supporting the Venstar ColorTouch API
+# parse out the id, name, type, and hostname from the SSDP response for a thermostat
+def _parseSSDPResponse(response):
+
+    usn = response.usn
+    tID = usn[usn.find("ecp:") + 4:usn.find(":name")].replace(":", "")
+    tName = unquote(usn[usn.find("name:") + 5:usn.find(":type")])
+    tType = usn[usn.find("type:") + 5:]
+    tHostName = urlparse(response.location).netloc
+    
+    return {
+        "id": tID,
+        "name": tName,
+        "type": tType,
+        "hostname": tHostName,
+        "usn": usn,
+        "location": response.location,
+        "maxage": response.cache,
+    }
+
+# discover devices as they respond 
+def iterDiscoverThermostats(timeout=5, logger=_LOGGER, interfaces=None):
+    """Discover thermostats on the network supporting the Venstar ColorTouch API, yielding each as it responds
         
     Parameters:
     timeout -- timeout for SSDP broadcast (defaults to 5)
     logger -- logger to use for errors 
+    interfaces -- list of IP addresses of the local interfaces to search on (defaults to the default interface)
+    Yields:
+    dictionary of id, name, type, hostname, and the SSDP usn, location, and maxage for each thermostat
     """
 
-    thermostats = []
+    # discover devices via the SSDP M-SEARCH method, retransmitting the search on a schedule
+    retransmit = [offset for offset in _SSDP_RETRANSMIT_SCHEDULE if offset < timeout]
+    for response in ssdp.discover_iter(_SSDP_SEARCH_TARGET, timeout=timeout, retransmit=retransmit, interfaces=interfaces):
 
-    # discover devices via the SSDP M-SEARCH method
-    responses = ssdp.discover(_SSDP_SEARCH_TARGET, timeout=timeout)
+        logger.debug("Thermostat found in discover - USN: %s, Location: %s", response.usn, response.location)
 
-    logger.debug("SSDP discovery returned %i thermostats.", len(responses))
+        yield _parseSSDPResponse(response)
 
-    # iterate through the responses 
-    for response in responses:
+# settings for resolving the hostnames of thermostats (in seconds)
+_DNS_RESOLVE_TIMEOUT = 5.0
+_DNS_CACHE_TTL = 300.0
 
-        logger.debug("Thermostat found in discover - USN: %s, Location: %s", response.usn, response.location)
+# resolver for thermostat hostnames with a cache, resolving the hostnames concurrently and refreshing them in the background
+class hostResolver(object):
+
+    _cache = None
+    _lock = None
+    _stopEvent = None
+    _thread = None
+    _onResolve = None
+    _ttl = _DNS_CACHE_TTL
+    _timeout = _DNS_RESOLVE_TIMEOUT
+    _logger = None
+
+    # Primary constructor method
+    def __init__(self, onResolve=None, ttl=_DNS_CACHE_TTL, timeout=_DNS_RESOLVE_TIMEOUT, logger=_LOGGER):
+        """Creates a resolver for thermostat hostnames
+
+        Parameters:
+        onResolve -- function called with the hostname and address when a hostname is first resolved or its address changes
+        ttl -- number of seconds a resolved address is cached (and the interval for refreshing in the background)
+        timeout -- timeout (in seconds) for resolving each hostname
+        logger -- logger to use for errors
+        """
+
+        self._cache = {}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._onResolve = onResolve
+        self._ttl = ttl
+        self._timeout = timeout
+        self._logger = logger
+
+    # resolve a hostname (optionally with a port) to an IP address (with the port)
+    async def _resolveHost(self, hostName):
+
+        # split off the port, if specified
+        try:
+            parsed = urlparse("//" + hostName)
+            host, port = parsed.hostname, parsed.port
+        except ValueError:
+            self._logger.warning("Invalid hostname %s.", hostName)
+            return None
+
+        try:
+            addresses = await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM), self._timeout)
+            address = addresses[0][4][0]
+        except (OSError, asyncio.TimeoutError) as e:
+            self._logger.warning("Unable to resolve hostname %s: %s", hostName, str(e) or type(e).__name__)
+            return None
+
+        return address if port is None else "{}:{}".format(address, port)
+
+    # resolve the hostnames, returning the results and the new and changed addresses
+    async def _resolveHosts(self, hostNames, refresh):
+
+        now = time.monotonic()
+        with self._lock:
+            results = {hostName: self._cache[hostName][0] for hostName in hostNames if hostName in self._cache and not refresh and self._cache[hostName][1] > now}
+        pending = [hostName for hostName in hostNames if hostName not in results]
+
+        addresses = await asyncio.gather(*[self._resolveHost(hostName) for hostName in pending])
+
+        changed = []
+        with self._lock:
+            for hostName, address in zip(pending, addresses):
+                previous = self._cache.get(hostName)
+                if address is None:
+                    results[hostName] = previous[0] if previous else None
+                    continue
+                self._cache[hostName] = (address, now + self._ttl)
+                results[hostName] = address
+                if previous is None or previous[0] != address:
+                    changed.append((hostName, address))
+
+        return results, changed
+
+    # notify the owner of new and changed addresses
+    def _notify(self, changed):
+
+        for hostName, address in changed:
+            self._logger.debug("Hostname %s resolved to %s.", hostName, address)
+            if self._onResolve is not None:
+                try:
+                    self._onResolve(hostName, address)
+                except Exception:
+                    self._logger.exception("Error in resolve callback for hostname %s.", hostName)
+
+    async def resolveAsync(self, hostNames, refresh=False):
+        """Resolves hostnames to IP addresses concurrently, using the cached addresses that have not expired
+
+        Parameters:
+        hostNames -- list of hostnames or IP addresses, optionally with a port (host:port)
+        refresh -- if True, resolve all of the hostnames even if cached
+        Returns:
+        dictionary of IP address (with the port, if specified) keyed by hostname, or None for hostnames that could not be resolved
+        Note: if a hostname can't be resolved, its last resolved address is returned
+        """
+
+        results, changed = await self._resolveHosts(hostNames, refresh)
+        self._notify(changed)
+        return results
+
+    def resolve(self, hostNames, refresh=False):
+        """Resolves hostnames to IP addresses concurrently - see resolveAsync()
+
+        Note: onResolve is called in the calling thread rather than on the background event loop
+        """
+
+        results, changed = _runSync(self._resolveHosts(hostNames, refresh))
+        self._notify(changed)
+        return results
+
+    # start refreshing the hostnames in a background thread
+    def start(self, hostNames):
+        """Starts resolving the hostnames in a background thread, right away and then each time the cache expires
+
+        Parameters:
+        hostNames -- list of hostnames or IP addresses, optionally with a port (host:port)
+        """
+
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._refresh, args=(hostNames,), name="hostResolver", daemon=True)
+        self._thread.start()
+
+    # stop refreshing the hostnames
+    def stop(self):
+        self._stopEvent.set()
+
+    # refresh the hostnames until stopped (runs in the resolver thread)
+    def _refresh(self, hostNames):
+
+        while not self._stopEvent.is_set():
+            try:
+                self.resolve(hostNames, refresh=True)
+            except Exception:
+                self._logger.exception("Error refreshing hostnames.")
+            self._stopEvent.wait(self._ttl)
+
+# pseudo-field in the state snapshots of the state feed for whether the thermostat responded (1) or not (0)
+STATE_FIELD_ONLINE = "online"
+
+# change in the state of a thermostat emitted by the state feed
+class stateChange(object):
+
+    __slots__ = ("key", "changes", "previous", "state", "full", "timestamp")
+
+    def __init__(self, key, changes, previous, state, full, timestamp):
+
+        self.key = key # key identifying the thermostat
+        self.changes = changes # new values of the changed fields (None for fields no longer returned)
+        self.previous = previous # previous values of the changed fields (None for fields not previously returned)
+        self.state = state # complete thermostatState, or None if the thermostat did not respond
+        self.full = full # True if all fields are included, whether changed or not
+        self.timestamp = timestamp # time of the change in epoch seconds
+
+    def __repr__(self):
+        return "stateChange({!r}, {!r})".format(self.key, self.changes)
+
+# subscription feed of thermostat state changes
+# Note: the thermostat API can't push changes, so the feed is fed by diffing consecutive states from a single poll loop
+class stateFeed(object):
+
+    _snapshots = None
+    _subscriptions = None
+    _nextToken = 0
+    _lock = None
+    _logger = None
+
+    # Primary constructor method
+    def __init__(self, logger=_LOGGER):
+        """Creates a feed of thermostat state changes
+
+        Parameters:
+        logger -- logger to use for errors
+        """
+
+        self._snapshots = {}
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._logger = logger
+
+    def subscribe(self, callback, fields=None, key=None):
+        """Registers a callback for changes in thermostat states
+
+        Parameters:
+        callback -- function called with a stateChange when one or more of the fields change
+        fields -- list of the state fields to watch, e.g. ("spacetemp", "state", STATE_FIELD_ONLINE) (defaults to all fields)
+        key -- key of the thermostat to watch (defaults to all thermostats)
+        Returns:
+        token for unsubscribe()
+        Note: the stateChange only includes the watched fields
+        """
+
+        with self._lock:
+            self._nextToken += 1
+            self._subscriptions[self._nextToken] = (callback, None if fields is None else tuple(fields), key)
+            return self._nextToken
+
+    def unsubscribe(self, token):
+        """Removes a callback registered with subscribe()
+
+        Parameters:
+        token -- token returned from subscribe()
+        """
+
+        with self._lock:
+            self._subscriptions.pop(token, None)
+
+    def update(self, key, state, full=False):
+        """Compares the state of a thermostat to its last state and notifies the subscribers of the changed fields
+
+        Parameters:
+        key -- key identifying the thermostat (e.g., hostname or node address)
+        state -- thermostatState from getThermostatState(), or None/False if the thermostat did not respond
+        full -- if True, the subscribers are notified of all of the fields, whether changed or not
+        Returns:
+        True if a change was dispatched to any subscriber, otherwise False (e.g., nothing changed)
+        Note: the callbacks are called in the calling thread and any exceptions they raise are logged
+        """
+
+        with self._lock:
+
+            # build the snapshot of the state, keeping the last values of the fields if the thermostat did not respond
+            previous = self._snapshots.get(key, {})
+            if state:
+                snapshot = {name: getattr(state, name) for name in state.__slots__ if getattr(state, name) is not None}
+                snapshot[STATE_FIELD_ONLINE] = 1
+            else:
+                snapshot = dict(previous)
+                snapshot[STATE_FIELD_ONLINE] = 0
+            self._snapshots[key] = snapshot
+            subscriptions = list(self._subscriptions.values())
+
+        # diff the snapshot against the last snapshot, including fields that are no longer returned
+        if full:
+            changes = dict(snapshot)
+        else:
+            changes = {field: snapshot.get(field) for field in snapshot.keys() | previous.keys() if snapshot.get(field) != previous.get(field)}
+        if not changes:
+            return False
+
+        # notify the subscribers watching the thermostat and any of the changed fields
+        timestamp = time.time()
+        dispatched = False
+        for callback, fields, subscribedKey in subscriptions:
+
+            if subscribedKey is not None and subscribedKey != key:
+                continue
+            watched = changes if fields is None else {field: changes[field] for field in fields if field in changes}
+            if not watched:
+                continue
+
+            dispatched = True
+            try:
+                callback(stateChange(key, watched, {field: previous.get(field) for field in watched}, state or None, full, timestamp))
+            except Exception:
+                self._logger.exception("Error in state change callback for thermostat %s.", key)
+
+        return dispatched
+
+    def reset(self, key):
+        """Forgets the last state of a thermostat, so all of the fields are reported as changed on the next update
+
+        Parameters:
+        key -- key identifying the thermostat
+        """
+
+        with self._lock:
+            self._snapshots.pop(key, None)
+
+    def getSnapshot(self, key):
+        """Returns a dictionary of the last state fields for a thermostat, or None if no state has been received"""
+
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            return None if snapshot is None else dict(snapshot)
+
+# default lifetime (in seconds) of a thermostat in the registry if the announcement has no max-age
+_SSDP_DEFAULT_MAX_AGE = 1800
+
+# live registry of the thermostats on the network maintained from SSDP announcements
+class thermostatRegistry(object):
+
+    _thermostats = None
+    _lock = None
+    _stopEvent = None
+    _thread = None
+    _logger = None
+    _onUpdate = None
+
+    # Primary constructor method
+    def __init__(self, onUpdate=None, logger=_LOGGER):
+        """Creates a registry of thermostats
+
+        Parameters:
+        onUpdate -- function called with the thermostat info when a thermostat is first seen or its hostname changes
+        logger -- logger to use for errors
+        """
+
+        self._thermostats = {}
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._onUpdate = onUpdate
+        self._logger = logger
+
+    # start listening for SSDP announcements in a background thread
+    def start(self, interfaces=None):
+        """Starts listening for SSDP NOTIFY announcements from thermostats
+
+        Parameters:
+        interfaces -- list of IP addresses of the local interfaces to listen on (defaults to the default interface)
+        """
+
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._listen, args=(interfaces,), name="ssdpListener", daemon=True)
+        self._thread.start()
+
+    # stop listening for SSDP announcements
+    def stop(self):
+        self._stopEvent.set()
+
+    # listen for SSDP announcements (runs in the listener thread)
+    def _listen(self, interfaces):
+
+        try:
+            ssdp.listen(self._handleNotify, self._stopEvent, interfaces)
+        except OSError as e:
+            self._logger.warning("Unable to listen for SSDP announcements: %s", str(e))
+
+    # process an SSDP announcement, logging any error so the listener keeps running
+    def _handleNotify(self, notify):
+
+        try:
+            self._processNotify(notify)
+        except Exception:
+            self._logger.exception("Error processing SSDP announcement from %s.", notify.location)
+
+    # update the registry from an SSDP announcement
+    def _processNotify(self, notify):
+
+        # ignore announcements from other devices
+        if notify.nt != _SSDP_SEARCH_TARGET or not notify.usn:
+            return
+
+        # remove thermostats leaving the network
+        if notify.nts == "ssdp:byebye":
+            with self._lock:
+                self._thermostats.pop(_parseSSDPResponse(notify)["id"], None)
+
+        elif notify.location:
+            self.update(_parseSSDPResponse(notify), notify.cache)
+
+    # add or refresh a thermostat in the registry
+    def update(self, thermostat, maxAge=None):
+        """Adds or refreshes a thermostat in the registry, e.g., from an announcement or active discovery
+
+        Parameters:
+        thermostat -- dictionary of id, name, type, and hostname for the thermostat
+        maxAge -- number of seconds the thermostat info is valid for
+        """
+
+        try:
+            expires = time.monotonic() + int(maxAge)
+        except (TypeError, ValueError):
+            expires = time.monotonic() + _SSDP_DEFAULT_MAX_AGE
+
+        with self._lock:
+            self._pruneExpired()
+            previous = self._thermostats.get(thermostat["id"])
+            self._thermostats[thermostat["id"]] = dict(thermostat, expires=expires)
+
+        # notify the owner of new thermostats and hostname (IP address) changes
+        if previous is None or previous["hostname"] != thermostat["hostname"]:
+            self._logger.debug("Thermostat %s announced at hostname %s.", thermostat["id"], thermostat["hostname"])
+            if self._onUpdate is not None:
+                try:
+                    self._onUpdate(thermostat)
+                except Exception:
+                    self._logger.exception("Error in update callback for thermostat %s.", thermostat["id"])
+
+    # get the thermostats currently in the registry
+    def getThermostats(self):
+        """Returns list of dictionaries of id, name, type, and hostname for the thermostats with unexpired announcements"""
+
+        with self._lock:
+            self._pruneExpired()
+            return list(self._thermostats.values())
+
+    # remove the thermostats with expired announcements
+    # Note: must be called with the lock held
+    def _pruneExpired(self):
+
+        now = time.monotonic()
+        for tID in [tID for tID in self._thermostats if self._thermostats[tID]["expires"] < now]:
+            del self._thermostats[tID]
+
+# discover devices 
+def discoverThermostats(timeout=5, logger=_LOGGER, interfaces=None):
+    """Discover thermostats on the network supporting the Venstar ColorTouch API - see iterDiscoverThermostats()"""
+
+    thermostats = list(iterDiscoverThermostats(timeout, logger, interfaces))
 
-        # parse out the id, name, type, and hostname from the response 
-        usn = response.usn
-        tID = usn[usn.find("ecp:") + 4:usn.find(":name")].replace(":", "")
-        tName = unquote(usn[usn.find("name:") + 5:usn.find(":type")])
-        tType = usn[usn.find("type:") + 5:]
-        tHostName = urlparse(response.location).netloc
-        thermostatInfo = {
-            "id": tID,
-            "name": tName,
-            "type": tType,
-            "hostname": tHostName
-        }
-
-        # append to thermostat list
-        thermostats.append(thermostatInfo)
+    logger.debug("SSDP discovery returned %i thermostats.", len(thermostats))
 
     return thermostats